@@ -35,11 +35,15 @@
     'website': 'https://www.cybrosys.com',
     'depends': ['payment', 'website_sale'],
     'data': [
+        'security/ir.model.access.csv',
         'views/payment_templates.xml',
         'data/cybersource_payment_method_data.xml',
         'data/cybersource_payment_provider_data.xml',
+        'data/res_partner_data.xml',
+        'data/ir_cron_data.xml',
         'views/payment_provider_views.xml',
         'views/payment_transaction_views.xml',
+        'views/res_partner_views.xml',
         'views/pay_with_link_templates.xml',
     ],
     'assets': {
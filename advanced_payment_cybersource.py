@@ -5,8 +5,6 @@ _logger = logging.getLogger(__name__)
 
 import json
 import os
-from CyberSource import *
-from CyberSource.logging.log_configuration import LogConfiguration
 from odoo import _, http
 from odoo.exceptions import ValidationError
 from odoo.http import request
@@ -55,6 +53,16 @@ class WebsiteSaleFormCyberSource(http.Controller):
     def payment_with_flex_token(self, **post):
         """ This is used for Payment processing using the flex token """
         _logger.info("=== CyberSource Payment Processing Started ===")
+        # The SDK is only imported once a payment is made
+        from CyberSource import CreatePaymentRequest, PaymentsApi, \
+            Ptsv2paymentsClientReferenceInformation, \
+            Ptsv2paymentsConsumerAuthenticationInformation, \
+            Ptsv2paymentsDeviceInformation, Ptsv2paymentsOrderInformation, \
+            Ptsv2paymentsOrderInformationAmountDetails, \
+            Ptsv2paymentsOrderInformationBillTo, \
+            Ptsv2paymentsPaymentInformation, \
+            Ptsv2paymentsPaymentInformationTokenizedCard, \
+            Ptsv2paymentsProcessingInformation
         _logger.info("Request user: %s (ID: %s)", request.env.user.name, request.env.user.id)
         try:
             # Get partner information with proper access control
@@ -336,6 +344,7 @@ class WebsiteSaleFormCyberSource(http.Controller):
 
     def get_configuration(self):
         """ This is used for Payment provider configuration """
+        from CyberSource.logging.log_configuration import LogConfiguration
         record = request.env['payment.provider'].sudo().search(
             [('code', '=', 'cybersource')])
         configuration_dictionary = {
@@ -19,6 +19,10 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 #
 ###############################################################################
+from . import account_move
 from . import account_payment_method
+from . import payment_cybersource_event
 from . import payment_provider
+from . import payment_token
 from . import payment_transaction
+from . import res_partner
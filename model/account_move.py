@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from collections import Counter
+
+from odoo import Command, api, fields, models
+from odoo.tools.sql import create_index
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountMove(models.Model):
+    """ Inherits account.move """
+    _inherit = 'account.move'
+
+    def _auto_init(self):
+        """ Index customer invoice names, which are the references of invoice
+        payments made through CyberSource payment links """
+        res = super()._auto_init()
+        create_index(
+            self._cr, 'account_move_cybersource_invoice_name_index',
+            self._table, ['name', 'move_type'],
+            where="move_type IN ('out_invoice', 'out_refund')")
+        return res
+
+    @api.model
+    def _cron_cybersource_charge_due_invoices(self):
+        """ Charge the due invoices of the customers who opted in on their
+        saved CyberSource cards. Invoices are read in keyset pages of the
+        provider batch size, and their payments are sent concurrently and
+        committed page by page. """
+        providers = self.env['payment.provider'].search([
+            ('code', '=', 'cybersource'), ('state', '!=', 'disabled'),
+        ])
+        for provider in providers:
+            start = time.monotonic()
+            domain = [
+                ('move_type', '=', 'out_invoice'),
+                ('state', '=', 'posted'),
+                ('payment_state', 'in', ('not_paid', 'partial')),
+                ('invoice_date_due', '<=', fields.Date.context_today(self)),
+                ('company_id', '=', provider.company_id.id),
+                ('partner_id.commercial_partner_id.cybersource_auto_charge', '=', True),
+            ]
+            stats = {'processed': 0, 'succeeded': 0, 'failed': 0, 'skipped': 0}
+            outcomes = Counter()
+            last_id = 0
+            while True:
+                invoices = self.search(domain + [('id', '>', last_id)],
+                                       order='id', limit=provider.cyber_batch_size or 100)
+                if not invoices:
+                    break
+                last_id = invoices[-1].id
+                transactions = invoices._cybersource_prepare_charges(provider)
+                stats['skipped'] += len(invoices) - len(transactions)
+                self.env.cr.commit()
+                page_stats = transactions._cybersource_charge_tokens(commit=True)
+                for key in ('processed', 'succeeded', 'failed', 'skipped'):
+                    stats[key] += page_stats[key]
+                outcomes.update(
+                    '%s/%s' % (tx.state, tx.cybersource_response_code or '-')
+                    for tx in transactions)
+            if stats['processed']:
+                self.env.ref('payment.cron_post_process_payment_tx')._trigger()
+                duration = time.monotonic() - start
+                _logger.info(
+                    "CyberSource invoice charges of %s: %s charged, %s failed, "
+                    "%s skipped in %.1fs (%.1f/s), outcomes: %s", provider.name,
+                    stats['succeeded'], stats['failed'], stats['skipped'],
+                    duration, stats['processed'] / (duration or 1), dict(outcomes))
+
+    def _cybersource_prepare_charges(self, provider):
+        """ Return the draft token transactions paying the invoices, created
+        unless a previous run left one. Invoices without a saved card, with a
+        payment in progress or charged without success today are skipped.
+        A draft left in flight by an interrupted run is searched at CyberSource
+        by the token payment batch rather than charged again. """
+        commercial_partners = self.partner_id.commercial_partner_id
+        tokens = self.env['payment.token'].search([
+            ('provider_id', '=', provider.id),
+            ('partner_id', 'child_of', commercial_partners.ids),
+        ], order='id desc')
+        token_by_partner = {}
+        for token in tokens:
+            token_by_partner.setdefault(token.partner_id.commercial_partner_id, token)
+        today = fields.Datetime.to_datetime(fields.Date.context_today(self))
+        transactions = self.env['payment.transaction']
+        vals_list = []
+        for invoice in self:
+            token = token_by_partner.get(invoice.partner_id.commercial_partner_id)
+            if not token or invoice.currency_id.is_zero(invoice.amount_residual):
+                continue
+            invoice_txs = invoice.transaction_ids.filtered(
+                lambda tx: tx.provider_id == provider)
+            if invoice_txs.filtered(
+                    lambda tx: tx.state in ('pending', 'authorized', 'done')
+                    or (tx.state in ('error', 'cancel') and tx.create_date >= today)):
+                continue
+            draft_txs = invoice_txs.filtered(lambda tx: tx.state == 'draft' and tx.token_id)
+            if draft_txs:
+                transactions |= draft_txs[:1]
+                continue
+            vals_list.append({
+                'provider_id': provider.id,
+                'payment_method_id': token.payment_method_id.id,
+                'token_id': token.id,
+                'amount': invoice.amount_residual,
+                'currency_id': invoice.currency_id.id,
+                'partner_id': invoice.partner_id.id,
+                'operation': 'offline',
+                'invoice_ids': [Command.set(invoice.ids)],
+                'reference': self.env['payment.transaction']._compute_reference(
+                    provider.code, prefix=invoice.name),
+            })
+        return transactions | self.env['payment.transaction'].create(vals_list)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#    Cybrosys Technologies Pvt. Ltd.
+#
+#    Copyright (C) 2024-TODAY Cybrosys Technologies(<https://www.cybrosys.com>)
+#    Author: Aysha Shalin (<odoo@cybrosys.com>)
+#
+#    You can modify it under the terms of the GNU LESSER
+#    GENERAL PUBLIC LICENSE (LGPL v3), Version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU LESSER GENERAL PUBLIC LICENSE (LGPL v3) for more details.
+#
+#    You should have received a copy of the GNU LESSER GENERAL PUBLIC LICENSE
+#    (LGPL v3) along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+import json
+import logging
+from datetime import timedelta
+
+from odoo import _, api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Transaction state matching the last part of a CyberSource event type, other
+# events (reviews, notifications) leave the transaction unchanged
+CYBERSOURCE_EVENT_STATES = {
+    'accept': 'done',
+    'reject': 'cancel',
+    'decline': 'cancel',
+}
+
+# Number of inbox events processed and committed together
+EVENT_BATCH_SIZE = 500
+
+# Age until which an event whose payment id is not on a transaction yet, as
+# when it arrives before the authorization is committed, stays pending
+EVENT_RETRY_AGE = timedelta(hours=1)
+
+
+class PaymentCyberSourceEvent(models.Model):
+    """ Inbox of the CyberSource webhook events, stored as received and
+    processed later by a scheduled action """
+    _name = 'payment.cybersource.event'
+    _description = 'CyberSource Webhook Event'
+    _order = 'id'
+    _log_access = False
+
+    event_id = fields.Char(string='Event ID', required=True, readonly=True,
+                           help='Notification id of the event at CyberSource')
+    provider_id = fields.Many2one('payment.provider', string='Provider',
+                                  readonly=True, ondelete='cascade')
+    event_type = fields.Char(string='Event Type', readonly=True)
+    payload = fields.Text(string='Payload', readonly=True,
+                          help='Raw body of the webhook request')
+    state = fields.Selection([('pending', 'Pending'), ('done', 'Done'),
+                              ('error', 'Error')], string='State',
+                             default='pending', required=True, index=True)
+    message = fields.Char(string='Message', readonly=True)
+    received_date = fields.Datetime(string='Received On', readonly=True,
+                                    default=fields.Datetime.now)
+
+    _sql_constraints = [
+        ('event_id_unique', 'UNIQUE(event_id)',
+         'A CyberSource event can only be received once.'),
+    ]
+
+    @api.model
+    def _cybersource_store_event(self, provider, body):
+        """ Insert a webhook event in the inbox, ignoring redeliveries of an
+        event already received. A single statement keeps the webhook response
+        immediate.
+
+        :param recordset provider: The provider the event was signed for
+        :param str body: The raw body of the webhook request
+        :return: Whether the event is new
+        :rtype: bool
+        """
+        event = json.loads(body)
+        event_id = event.get('notificationId') or event.get('eventId')
+        if not event_id:
+            raise ValueError("CyberSource event without notification id")
+        self.env.cr.execute("""
+            INSERT INTO payment_cybersource_event
+                (event_id, provider_id, event_type, payload, state, received_date)
+            VALUES (%s, %s, %s, %s, 'pending', NOW() AT TIME ZONE 'UTC')
+            ON CONFLICT (event_id) DO NOTHING
+        """, [event_id, provider.id, event.get('eventType'), body])
+        return bool(self.env.cr.rowcount)
+
+    @api.model
+    def _cybersource_trigger_processing(self):
+        """ Have the inbox processed as soon as possible. A trigger is only
+        added when none is pending, so that a burst of webhooks adds one. """
+        cron = self.env.ref(
+            'advanced_payment_cybersource.ir_cron_cybersource_process_events')
+        if not self.env['ir.cron.trigger'].search([('cron_id', '=', cron.id)],
+                                                  limit=1):
+            cron._trigger()
+
+    @api.model
+    def _cron_process_events(self):
+        """ Process the pending inbox events in batches. Batches are locked
+        with SKIP LOCKED so that concurrent runs share the backlog, and read
+        by increasing id so that events left pending wait for the next run.
+        """
+        last_id = 0
+        while True:
+            self.env.cr.execute("""
+                SELECT id FROM payment_cybersource_event
+                WHERE state = 'pending' AND id > %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, [last_id, EVENT_BATCH_SIZE])
+            events = self.browse([row[0] for row in self.env.cr.fetchall()])
+            if not events:
+                break
+            last_id = events[-1].id
+            events._process_events()
+            self.env.cr.commit()
+
+    def _process_events(self):
+        """ Apply the events to their transactions. Only the last event
+        changing the state of each CyberSource payment is applied, earlier
+        ones being superseded. Accepted captures set their transaction done,
+        other accepted payments set it done or authorized, depending on the
+        capture mode. Events whose payment is not on a transaction yet are
+        left pending until they are too old. """
+        latest_events = {}
+        for event in self:
+            try:
+                data = json.loads(event.payload)
+                payment_id = data['payload']['data']['id']
+            except (ValueError, KeyError, TypeError):
+                event.write({'state': 'error', 'message': _("Unreadable event")})
+                continue
+            if not CYBERSOURCE_EVENT_STATES.get(
+                    (event.event_type or '').rsplit('.', 1)[-1]):
+                event.write({'state': 'done', 'message': _("Nothing to update")})
+                continue
+            previous = latest_events.pop(payment_id, None)
+            if previous:
+                previous.write({'state': 'done', 'message': _("Superseded")})
+            latest_events[payment_id] = event
+
+        transactions = self.env['payment.transaction'].search([
+            ('provider_code', '=', 'cybersource'),
+            ('cybersource_payment_id', 'in', list(latest_events)),
+        ])
+        tx_by_payment_id = {tx.cybersource_payment_id: tx for tx in transactions}
+        for payment_id, event in latest_events.items():
+            tx = tx_by_payment_id.get(payment_id)
+            state = CYBERSOURCE_EVENT_STATES.get(
+                (event.event_type or '').rsplit('.', 1)[-1])
+            if not tx:
+                if event.received_date > fields.Datetime.now() - EVENT_RETRY_AGE:
+                    event.message = _("Waiting for the transaction")
+                else:
+                    event.write({'state': 'error',
+                                 'message': _("No transaction found")})
+                continue
+            if tx.state not in ('draft', 'pending', 'authorized'):
+                event.write({'state': 'done', 'message': _("Nothing to update")})
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    tx._handle_notification_data('cybersource', {
+                        'reference': tx.reference,
+                        'simulated_state': state,
+                        'manual_capture': '.captures.' in (event.event_type or ''),
+                        'cybersource_status': event.event_type,
+                        'message': _("CyberSource event %s", event.event_type),
+                        'approval_code': tx.cybersource_approval_code,
+                    })
+            except Exception as e:
+                _logger.exception("CyberSource event %s failed", event.event_id)
+                event.write({'state': 'error', 'message': str(e)})
+                continue
+            event.write({'state': 'done', 'message': False})
+        _logger.info("CyberSource events processed: %s", len(self))
@@ -19,7 +19,128 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 #
 ###############################################################################
-from odoo import fields, models
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+
+from odoo import api, fields, models, tools
+from odoo.addons.advanced_payment_cybersource import utils
+from odoo.modules.registry import Registry
+
+_logger = logging.getLogger(__name__)
+
+# Fields whose change must drop the cached CyberSource clients
+CYBERSOURCE_CLIENT_FIELDS = ('cyber_merchant', 'cyber_key', 'cyber_secret_key',
+                             'cyber_run_environment',
+                             'cyber_pool_size', 'cyber_pool_idle_timeout',
+                             'cyber_pool_max_age', 'cyber_sdk_logging')
+
+# Seconds a signed webhook request stays valid, against replays
+WEBHOOK_SIGNATURE_TOLERANCE = 300
+
+# Device fingerprinting organisation ids of the CyberSource environments
+CYBERSOURCE_ORG_IDS = {
+    'enabled': 'k8vif92e',
+    'test': '1snn5n9w',
+}
+
+# Markup holding the device fingerprinting tags on payment pages
+CYBERSOURCE_FINGERPRINT_CONTAINER = """
+            <div id="cybersource_df_container" class="d-none">
+                <!-- Container for CyberSource device fingerprint -->
+            </div>
+        """
+
+# Circuit breaker: outcomes of the last CIRCUIT_WINDOW seconds are counted per
+# worker, and the circuit only opens once CIRCUIT_MIN_CALLS were seen. The
+# open state is stored on the provider so that all workers share it. Once the
+# pause is over, the probe let through is held by the thread sending it, and is
+# presumed lost when not recorded within the retry deadline and timeouts.
+CIRCUIT_WINDOW = 60
+CIRCUIT_MIN_CALLS = 10
+_circuit_lock = threading.Lock()
+_circuits = {}
+
+# Checkout stage histograms measured by this worker and not yet added to the
+# histograms stored on the provider, which is done every METRICS_FLUSH_INTERVAL
+# seconds per provider
+METRICS_FLUSH_INTERVAL = 30
+_metrics_lock = threading.Lock()
+_pending_metrics = {}
+_metrics_flushed_at = {}
+
+# Registry of CyberSource clients shared by all the threads of the worker:
+# (database, provider id) -> (write_date, configuration, {api name: [idle
+# clients]}). The SDK clients keep request state (signature headers) while a
+# call runs, so each client is checked out by a single thread at a time and
+# given back afterwards: the idle clients, and their keep-alive connections,
+# serve the next requests whatever the thread sending them.
+# The SDK, made of over two thousand generated modules, is only imported when
+# the first client is built, so workers never calling CyberSource skip it.
+_client_lock = threading.Lock()
+_client_registry = {}
+
+
+def get_cybersource_configuration(key, write_date, configuration):
+    """ Return the registry entry of a provider, replacing it when the
+    provider changed
+
+    :param tuple key: The (database, provider id) pair of the provider
+    :param datetime write_date: The last modification date of the provider
+    :param configuration: The SDK configuration, or a callable returning it
+    :return: The (write_date, configuration, idle clients) entry
+    :rtype: tuple
+    """
+    with _client_lock:
+        cached = _client_registry.get(key)
+    if cached and cached[0] == write_date:
+        return cached
+    if callable(configuration):
+        configuration = configuration()
+    with _client_lock:
+        cached = _client_registry.get(key)
+        if not cached or cached[0] != write_date:
+            cached = _client_registry[key] = (write_date, configuration, {})
+        return cached
+
+
+@contextmanager
+def cybersource_api(key, write_date, configuration, api_name):
+    """ Check out an idle `api_name` client of a provider for the duration
+    of a `with` block, building one when none is idle. Usable from threads
+    without an environment.
+
+    :param tuple key: The (database, provider id) pair of the provider
+    :param datetime write_date: The last modification date of the provider
+    :param configuration: The SDK configuration, or a callable returning it
+    :param str api_name: The name of the SDK API class, e.g. `PaymentsApi`
+    :return: The SDK API client
+    """
+    cached = get_cybersource_configuration(key, write_date, configuration)
+    with _client_lock:
+        idle = cached[2].setdefault(api_name, [])
+        client = idle.pop() if idle else None
+    if client is None:
+        import CyberSource
+        _logger.info("Building CyberSource %s client for provider %s",
+                     api_name, key[1])
+        client = getattr(CyberSource, api_name)(cached[1])
+    try:
+        yield client
+    finally:
+        with _client_lock:
+            # The clients of a replaced or cleared entry are dropped
+            if _client_registry.get(key) is cached:
+                cached[2][api_name].append(client)
 
 
 class PaymentProvider(models.Model):
@@ -35,3 +156,446 @@ class PaymentProvider(models.Model):
     cyber_secret_key = fields.Char(string='Secret Key',
                                    help='Cybersource secret key')
     cyber_key = fields.Char(string='Secret Key', help='Cyber key')
+    cyber_run_environment = fields.Char(
+        string='API Host', default='api.cybersource.com', required=True,
+        help='CyberSource API host: api.cybersource.com in production, '
+             'apitest.cybersource.com for the sandbox, or the URL of a local '
+             'stand-in server such as http://localhost:8099')
+    cyber_webhook_secret = fields.Char(
+        string='Webhook Secret', groups='base.group_system',
+        help='Base64 key of the CyberSource webhook subscription, used to '
+             'verify the signature of the notifications')
+    cyber_pool_size = fields.Integer(
+        string='Connection Pool Size', default=10,
+        help='Maximum number of keep-alive connections to CyberSource kept '
+             'open by each worker')
+    cyber_pool_idle_timeout = fields.Integer(
+        string='Idle Timeout (s)', default=60,
+        help='Seconds an unused connection is kept open before being closed')
+    cyber_pool_max_age = fields.Integer(
+        string='Max Connection Age (s)', default=300,
+        help='Seconds after which a connection is recycled even if in use')
+    cyber_log_mode = fields.Selection(
+        [('off', 'Off'), ('summary', 'Summary'),
+         ('sampled', 'Sampled Payloads')],
+        string='Payment Logging', default='summary',
+        help='Off: no per-payment log line. Summary: one line per payment. '
+             'Sampled Payloads: summary plus the masked request and '
+             'response of a sample of the payments.')
+    cyber_log_sample_rate = fields.Integer(
+        string='Payload Sample Rate (%)', default=1,
+        help='Percentage of payments whose payloads are logged')
+    cyber_sdk_logging = fields.Boolean(
+        string='SDK File Logging',
+        help='Let the CyberSource SDK write its own masked debug log to '
+             'Logs/cybs in the server working directory')
+    cyber_max_attempts = fields.Integer(
+        string='Max Authorization Attempts', default=2,
+        help='Maximum number of requests sent for one payment, the 3D Secure '
+             'retry included')
+    cyber_retry_deadline = fields.Integer(
+        string='Authorization Deadline (s)', default=30,
+        help='No retry is started once this many seconds have passed since '
+             'the first request of a payment')
+    cyber_batch_size = fields.Integer(
+        string='Batch Size', default=100,
+        help='Number of transactions processed and committed together by '
+             'the scheduled CyberSource jobs')
+    cyber_batch_workers = fields.Integer(
+        string='Batch Concurrency', default=8,
+        help='Number of concurrent requests sent to CyberSource by the '
+             'scheduled jobs')
+    cyber_batch_rate_limit = fields.Integer(
+        string='Batch Rate Limit (req/s)', default=0,
+        help='Maximum number of requests per second sent by the scheduled '
+             'jobs, 0 for no limit')
+    cyber_stale_authorization_days = fields.Integer(
+        string='Reverse Authorizations After (days)', default=7,
+        help='Authorized or pending transactions older than this are reversed '
+             'by the scheduled job, releasing the held funds')
+    cyber_reversal_run_limit = fields.Integer(
+        string='Reversals per Run', default=1000,
+        help='Maximum number of authorizations reversed by one run of the '
+             'scheduled job, 0 for no limit')
+    cyber_reconcile_time_budget = fields.Integer(
+        string='Status Check Budget (s)', default=300,
+        help='Time after which the scheduled check of pending transactions '
+             'stops, leaving the rest for its next run')
+    cyber_connect_timeout = fields.Float(
+        string='Connect Timeout (s)', default=5,
+        help='Maximum time to open a connection to CyberSource')
+    cyber_read_timeout = fields.Float(
+        string='Read Timeout (s)', default=30,
+        help='Maximum time to wait for a CyberSource response')
+    cyber_circuit_error_rate = fields.Integer(
+        string='Circuit Breaker Error Rate (%)', default=50,
+        help='Share of failed or slow authorizations over the last minute '
+             'above which payments are refused at once, 0 to disable')
+    cyber_circuit_slow_call = fields.Float(
+        string='Circuit Breaker Slow Call (s)', default=10,
+        help='Authorizations slower than this count as failures')
+    cyber_circuit_open_time = fields.Integer(
+        string='Circuit Breaker Pause (s)', default=30,
+        help='Time payments are refused once the circuit opened, before a '
+             'probe request is let through')
+    cyber_circuit_open_until = fields.Datetime(
+        string='Circuit Open Until', readonly=True, copy=False,
+        help='Payments are refused until this time, as CyberSource is failing')
+    cyber_metrics = fields.Json(
+        string='Checkout Metrics', readonly=True, copy=False,
+        help='Histograms of the duration and SQL queries of the checkout '
+             'stages, summed over all workers')
+    cyber_metrics_token = fields.Char(
+        string='Metrics Token', groups='base.group_system', copy=False,
+        help='Bearer token giving access to /payment/cybersource/metrics')
+    cyber_async_authorization = fields.Boolean(
+        string='Asynchronous Authorization',
+        help='Send authorizations from a background pool so that web workers '
+             'are not blocked while CyberSource responds. The browser polls '
+             'the transaction state until the result is known.')
+    cyber_async_workers = fields.Integer(
+        string='Authorization Threads', default=4,
+        help='Number of background authorization threads per worker')
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        """ Invalidate the cached CyberSource provider lookup """
+        providers = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return providers
+
+    def write(self, vals):
+        """ Drop the cached CyberSource clients when their settings change,
+        and the cached provider lookup on any change to a CyberSource
+        provider """
+        was_cybersource = any(provider.code == 'cybersource' for provider in self)
+        res = super().write(vals)
+        if any(field in vals for field in CYBERSOURCE_CLIENT_FIELDS):
+            self._cybersource_clear_client_cache()
+        if was_cybersource or any(provider.code == 'cybersource' for provider in self):
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        """ Invalidate the cached CyberSource provider lookup """
+        self._cybersource_clear_client_cache()
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
+    def _compute_feature_support_fields(self):
+        """ Override of `payment` to enable the capture of authorizations and
+        the tokenization of cards """
+        super()._compute_feature_support_fields()
+        self.filtered(lambda p: p.code == 'cybersource').update({
+            'support_manual_capture': 'full_only',
+            'support_tokenization': True,
+        })
+
+    @api.model
+    def _cybersource_get_provider(self, company_id=None, website_id=False):
+        """ Return the enabled CyberSource provider of the company and
+        website, falling back on any enabled CyberSource provider """
+        company_id = company_id or self.env.company.id
+        return self.sudo().browse(
+            self._cybersource_get_provider_id(company_id, website_id))
+
+    @api.model
+    @tools.ormcache('company_id', 'website_id')
+    def _cybersource_get_provider_id(self, company_id, website_id):
+        """ Return the id of the enabled CyberSource provider of the company,
+        preferring the providers of the website or of no website, in sequence
+        order. Cached until a CyberSource provider is created, modified or
+        deleted. """
+        domain = [('code', '=', 'cybersource'), ('state', '!=', 'disabled')]
+        providers = self.sudo().search(domain, order='sequence, id')
+        # Sorting is stable, the sequence order is kept within each rank
+        provider = providers.sorted(lambda p: (
+            p.company_id.id != company_id,
+            p.website_id.id not in (website_id, False),
+        ))[:1]
+        return provider.id or False
+
+    def _cybersource_clear_client_cache(self):
+        """ Remove the cached clients of these providers for this worker """
+        with _client_lock:
+            for provider_id in self.ids:
+                _client_registry.pop((self.env.cr.dbname, provider_id), None)
+
+    def _cybersource_get_bootstrap_values(self):
+        """ Return everything the checkout needs from the provider, in one
+        payload: enabled flag, merchant id, fingerprint container and
+        device fingerprinting organisation id """
+        if not self:
+            return {
+                'enabled': False,
+                'merchant_id': False,
+                'org_id': False,
+                'fingerprint_container': "",
+            }
+        self.ensure_one()
+        return {
+            'enabled': True,
+            'merchant_id': self.cyber_merchant or False,
+            'org_id': CYBERSOURCE_ORG_IDS.get(self.state,
+                                              CYBERSOURCE_ORG_IDS['test']),
+            'fingerprint_container': CYBERSOURCE_FINGERPRINT_CONTAINER,
+        }
+
+    def _cybersource_get_configuration(self):
+        """ Return the CyberSource SDK configuration of the provider """
+        self.ensure_one()
+        configuration_dictionary = {
+            "authentication_type": "http_signature",
+            "merchantid": self.cyber_merchant,
+            "run_environment": self.cyber_run_environment or "api.cybersource.com",
+            "request_json_path": "",
+            "key_alias": "testrest",
+            "key_password": "testrest",
+            "key_file_name": "testrest",
+            "keys_directory": os.path.join(os.getcwd(), "resources"),
+            "merchant_keyid": self.cyber_key,
+            "merchant_secretkey": self.cyber_secret_key,
+            "portfolio_id": "",
+            "maxNumIdleConnections": self.cyber_pool_size or 10,
+            "maxKeepAliveIdleWindow": self.cyber_pool_idle_timeout or 60,
+            "maxKeepAliveDelay": self.cyber_pool_max_age or 300,
+        }
+        # With its logging disabled, the SDK can only parse configurations
+        # made of strings and numbers: no log configuration is given then,
+        # and `use_metakey` is left to its False default
+        if not self.cyber_sdk_logging:
+            return configuration_dictionary
+        from CyberSource.logging.log_configuration import LogConfiguration
+        log_config = LogConfiguration()
+        log_config.set_enable_log(True)
+        log_config.set_log_directory(os.path.join(os.getcwd(), "Logs"))
+        log_config.set_log_file_name("cybs")
+        log_config.set_log_maximum_size(10487560)
+        log_config.set_log_level("Debug")
+        log_config.set_enable_masking(True)
+        log_config.set_log_format(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        log_config.set_log_date_format("%Y-%m-%d %H:%M:%S")
+        configuration_dictionary["log_config"] = log_config
+        return configuration_dictionary
+
+    def _cybersource_should_log_payload(self):
+        """ Return whether the payloads of the current payment are logged,
+        according to the logging mode and sample rate of the provider """
+        if self.cyber_log_mode != 'sampled' or not _logger.isEnabledFor(
+                logging.INFO):
+            return False
+        return random.random() * 100 < self.cyber_log_sample_rate
+
+    def _cybersource_get_api(self, api_name):
+        """ Check out a cached `api_name` client of the provider, to be used
+        in a `with` statement """
+        self.ensure_one()
+        return cybersource_api(
+            (self.env.cr.dbname, self.id), self.write_date,
+            self._cybersource_get_configuration, api_name)
+
+    def _cybersource_build_client(self, api_name='PaymentsApi'):
+        """ Make sure an `api_name` client of the provider is cached, raising
+        the configuration and SDK errors before a request is prepared """
+        with self._cybersource_get_api(api_name):
+            pass
+
+    def _cybersource_get_cached_configuration(self):
+        """ Return the cached SDK configuration of the provider, building it
+        on first use or when the provider changed """
+        self.ensure_one()
+        return get_cybersource_configuration(
+            (self.env.cr.dbname, self.id), self.write_date,
+            self._cybersource_get_configuration)[1]
+
+    def _cybersource_verify_webhook_signature(self, body, signature_header):
+        """ Check the `v-c-signature` header of a webhook request, of the
+        form `t=<timestamp>;keyId=<key id>;sig=<base64 HMAC-SHA256>`, where the
+        signed message is `<timestamp>.<body>`.
+
+        :param bytes body: The raw body of the request
+        :param str signature_header: The signature header
+        :return: Whether the signature is valid and recent
+        :rtype: bool
+        """
+        self.ensure_one()
+        secret = self.sudo().cyber_webhook_secret
+        if not secret or not signature_header:
+            return False
+        parts = dict(part.strip().split('=', 1)
+                     for part in signature_header.split(';') if '=' in part)
+        timestamp, signature = parts.get('t', ''), parts.get('sig', '')
+        if not timestamp.isdigit() or not signature:
+            return False
+        # Timestamps may be sent in milliseconds
+        seconds = int(timestamp) / 1000 if len(timestamp) > 11 else int(timestamp)
+        if abs(time.time() - seconds) > WEBHOOK_SIGNATURE_TOLERANCE:
+            return False
+        try:
+            key = base64.b64decode(secret)
+        except ValueError:
+            key = secret.encode()
+        expected = base64.b64encode(hmac.new(
+            key, timestamp.encode() + b'.' + body, hashlib.sha256).digest())
+        return hmac.compare_digest(expected, signature.encode())
+
+    def _cybersource_get_timeout(self):
+        """ Return the (connect, read) timeouts of the SDK requests """
+        self.ensure_one()
+        return (self.cyber_connect_timeout or 5, self.cyber_read_timeout or 30)
+
+    def _cybersource_circuit_allows(self):
+        """ Return whether a payment may be sent to CyberSource. While the
+        circuit is open, payments are refused without calling CyberSource;
+        once the pause is over, each worker lets a single probe through. A
+        probe not sent must be given back with `_cybersource_circuit_release`.
+        """
+        self.ensure_one()
+        if not self.cyber_circuit_error_rate or not self.cyber_circuit_open_until:
+            return True
+        if fields.Datetime.now() < self.cyber_circuit_open_until:
+            return False
+        now = time.monotonic()
+        probe_timeout = (self.cyber_retry_deadline or 30) + sum(
+            self._cybersource_get_timeout())
+        with _circuit_lock:
+            circuit = self._cybersource_get_circuit()
+            if circuit['probing'] and circuit['probing'][1] > now - probe_timeout:
+                return False
+            circuit['probing'] = (threading.get_ident(), now)
+        return True
+
+    def _cybersource_circuit_release(self):
+        """ Give back the probe taken by the current thread, if it was not
+        sent to CyberSource """
+        self.ensure_one()
+        with _circuit_lock:
+            circuit = self._cybersource_get_circuit()
+            if circuit['probing'] and circuit['probing'][0] == threading.get_ident():
+                circuit['probing'] = None
+
+    def _cybersource_circuit_record(self, failed, latency):
+        """ Record the outcome of a CyberSource request and open or close the
+        circuit accordingly
+
+        :param bool failed: Whether CyberSource failed to answer
+        :param float latency: The duration of the request in seconds
+        """
+        self.ensure_one()
+        failed = failed or latency > (self.cyber_circuit_slow_call or 10)
+        now = time.monotonic()
+        with _circuit_lock:
+            circuit = self._cybersource_get_circuit()
+            was_probing, circuit['probing'] = circuit['probing'], None
+            if not self.cyber_circuit_error_rate:
+                return
+            calls = circuit['calls']
+            calls.append((now, failed))
+            while calls[0][0] < now - CIRCUIT_WINDOW:
+                calls.popleft()
+            failures = sum(1 for _call_time, call_failed in calls if call_failed)
+            should_open = (len(calls) >= CIRCUIT_MIN_CALLS and failures * 100
+                           >= self.cyber_circuit_error_rate * len(calls))
+            if should_open:
+                calls.clear()
+        if self.cyber_circuit_open_until:
+            if was_probing:
+                self._cybersource_set_circuit(is_open=failed)
+        elif should_open:
+            self._cybersource_set_circuit(is_open=True)
+
+    def _cybersource_get_circuit(self):
+        """ Return the in-memory circuit of the provider, the caller holding
+        the circuit lock """
+        return _circuits.setdefault((self.env.cr.dbname, self.id), {
+            'calls': deque(), 'probing': None})
+
+    def _cybersource_set_circuit(self, is_open):
+        """ Open or close the circuit for all workers. The state is committed
+        at once in its own cursor, without changing the write date of the
+        provider, which would rebuild its clients. """
+        open_until = is_open and fields.Datetime.now() + timedelta(
+            seconds=self.cyber_circuit_open_time or 30)
+        with Registry(self.env.cr.dbname).cursor() as cr:
+            cr.execute("""
+                UPDATE payment_provider SET cyber_circuit_open_until = %s
+                WHERE id = %s
+            """, [open_until or None, self.id])
+        self.invalidate_recordset(['cyber_circuit_open_until'])
+        if is_open:
+            _logger.warning("CyberSource circuit of %s opened until %s",
+                            self.name, open_until)
+        else:
+            _logger.info("CyberSource circuit of %s closed", self.name)
+
+    def _cybersource_record_metrics(self, stages):
+        """ Add the stages of a checkout to the histograms of this worker,
+        flushing them to the provider when due
+
+        :param list stages: The (stage, seconds, queries) measures
+        """
+        if not self or not stages:
+            return
+        key = (self.env.cr.dbname, self.id)
+        with _metrics_lock:
+            utils.add_to_histograms(_pending_metrics.setdefault(key, {}), stages)
+            due = (time.monotonic() - _metrics_flushed_at.get(key, 0)
+                   >= METRICS_FLUSH_INTERVAL)
+        if due:
+            self._cybersource_flush_metrics()
+
+    def _cybersource_flush_metrics(self):
+        """ Add the histograms of this worker to those stored on the provider,
+        in their own cursor, without changing the write date of the
+        provider """
+        self.ensure_one()
+        key = (self.env.cr.dbname, self.id)
+        with _metrics_lock:
+            pending = _pending_metrics.pop(key, None)
+            _metrics_flushed_at[key] = time.monotonic()
+        if not pending:
+            return
+        with Registry(self.env.cr.dbname).cursor() as cr:
+            cr.execute("""
+                SELECT cyber_metrics FROM payment_provider WHERE id = %s FOR UPDATE
+            """, [self.id])
+            stored = cr.fetchone()[0] or {}
+            cr.execute("""
+                UPDATE payment_provider SET cyber_metrics = %s WHERE id = %s
+            """, [json.dumps(utils.merge_histograms(stored, pending)), self.id])
+        self.invalidate_recordset(['cyber_metrics'])
+
+    def _cybersource_get_pool_stats(self):
+        """ Return the keep-alive pool statistics of the idle PaymentsApi
+        clients of the provider in this worker, summed per remote host """
+        self.ensure_one()
+        with _client_lock:
+            cached = _client_registry.get((self.env.cr.dbname, self.id))
+            clients = list(cached[2].get('PaymentsApi', ())) if cached else []
+        stats = {}
+        for payments_api in clients:
+            pools = payments_api.api_client.rest_client.pool_manager.pools
+            if hasattr(pools, 'keys'):
+                pools = [pools.get(key) for key in pools.keys()]
+            else:
+                # urllib3-future, required by the recent SDKs, keeps its pools
+                # in a registry with no public listing
+                pools = list(pools._registry.values())
+            for pool in pools:
+                if pool is None:
+                    continue
+                host_stats = stats.setdefault((pool.host, pool.port), {
+                    'host': pool.host,
+                    'port': pool.port,
+                    'max_connections': 0,
+                    'open_connections': 0,
+                    'idle_connections': 0,
+                    'requests': 0,
+                })
+                host_stats['max_connections'] += pool.pool.maxsize if pool.pool else 0
+                host_stats['open_connections'] += pool.num_connections
+                host_stats['idle_connections'] += pool.pool.qsize() if pool.pool else 0
+                host_stats['requests'] += pool.num_requests
+        return list(stats.values())
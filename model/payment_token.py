@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+#    Cybrosys Technologies Pvt. Ltd.
+#
+#    Copyright (C) 2024-TODAY Cybrosys Technologies(<https://www.cybrosys.com>)
+#    Author: Aysha Shalin (<odoo@cybrosys.com>)
+#
+#    You can modify it under the terms of the GNU LESSER
+#    GENERAL PUBLIC LICENSE (LGPL v3), Version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU LESSER GENERAL PUBLIC LICENSE (LGPL v3) for more details.
+#
+#    You should have received a copy of the GNU LESSER GENERAL PUBLIC LICENSE
+#    (LGPL v3) along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+from odoo import fields, models
+
+
+class PaymentToken(models.Model):
+    """ Inherits payment.token to store the CyberSource customer token """
+    _inherit = 'payment.token'
+
+    cybersource_customer_id = fields.Char(
+        string="CyberSource Customer Token", readonly=True,
+        help="Customer token of the CyberSource Token Management Service, "
+             "the provider reference being the payment instrument token")
+    cybersource_network_transaction_id = fields.Char(
+        string="CyberSource Network Transaction ID", readonly=True,
+        help="Network transaction id of the payment which stored the card, "
+             "sent with the merchant initiated charges of the token")
@@ -1,11 +1,133 @@
 # -*- coding: utf-8 -*-
-from odoo import api, fields, models, _
+from odoo import api, fields, models, SUPERUSER_ID, _
 from odoo.exceptions import ValidationError
+from odoo.addons.advanced_payment_cybersource import utils
+from odoo.addons.advanced_payment_cybersource.model.payment_provider import \
+    cybersource_api
+from odoo.modules.registry import Registry
+from odoo.tools import float_compare, float_repr, mute_logger, split_every
+from odoo.tools.sql import create_index
+from datetime import timedelta
+from psycopg2.errors import LockNotAvailable
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import json
+import threading
+import time
+import urllib3
 
 _logger = logging.getLogger(__name__)
 
+# Mapping of CyberSource authorization statuses to transaction states, any
+# other status is considered successful
+CYBERSOURCE_STATUS_MAPPING = {
+    'AUTHORIZED': 'done',
+    'PARTIAL_AUTHORIZED': 'done',
+    'AUTHORIZED_PENDING_REVIEW': 'pending',
+    'DECLINED': 'cancel',
+    'PENDING': 'pending',
+}
+
+# Time after which an authorization without outcome is no longer considered
+# in flight, e.g. when its worker died, and is searched at CyberSource
+CYBERSOURCE_IN_FLIGHT_TIMEOUT = timedelta(minutes=2)
+
+# Time CyberSource may take to make a transaction searchable. A request left
+# in flight and not found by a search older than this never reached it.
+CYBERSOURCE_SEARCH_DELAY = timedelta(minutes=15)
+
+# Errors of requests sent without response, besides the ApiException of the
+# SDK, which carries the HTTP status of the response, 0 on TLS errors
+CYBERSOURCE_TRANSPORT_ERRORS = (OSError, urllib3.exceptions.HTTPError)
+
+# HTTP statuses of batch requests worth retrying, None meaning no response
+CYBERSOURCE_RETRY_STATUSES = (None, 429, 500, 502, 503, 504)
+
+# Error field returned by CyberSource when 3-D Secure data is required
+CYBERSOURCE_3DS_REQUIRED = 'consumerAuthenticationInformation.cavv'
+
+# Per-worker pool running asynchronous authorizations. The semaphore bounds
+# the number of queued and running authorizations so that bursts beyond it
+# are processed inline instead of piling up in memory.
+_async_lock = threading.Lock()
+_async_pool = {}
+
+
+def _get_async_pool(max_workers):
+    """ Return the (executor, semaphore) pair of this worker, rebuilding it
+    when the configured size changed """
+    with _async_lock:
+        if _async_pool.get('size') != max_workers:
+            if _async_pool.get('executor'):
+                _async_pool['executor'].shutdown(wait=False)
+            _async_pool.update({
+                'size': max_workers,
+                'executor': ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    thread_name_prefix='cybersource_authorization'),
+                'slots': threading.BoundedSemaphore(max_workers * 2),
+            })
+        return _async_pool['executor'], _async_pool['slots']
+
+
+def _authorize_in_background(dbname, provider_id, payload, notification_values,
+                             slots):
+    """ Send an authorization from the background pool, in its own cursor """
+    try:
+        with Registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['payment.transaction']._cybersource_authorize_and_finalize(
+                env['payment.provider'].browse(provider_id), payload,
+                notification_values)
+    except Exception:
+        _logger.exception("Asynchronous CyberSource authorization of %s failed",
+                          notification_values.get('reference'))
+    finally:
+        slots.release()
+
+
+def _parse_response_body(body):
+    """ Return the parsed body of a CyberSource response, wrapping a body
+    that is not JSON, e.g. the error page of a proxy, as its message """
+    try:
+        return json.loads(body) if body else {}
+    except ValueError:
+        return {'message': body}
+
+
+def _call_cybersource(key, write_date, configuration, timeout, limiter,
+                      retries, api_name, method, args):
+    """ Send one request of a batch from a worker thread, retrying up to
+    `retries` times with exponential backoff when CyberSource is unavailable
+    or throttling. Never raises.
+
+    :return: The HTTP status, or None if no response was received, and the
+             parsed response body
+    :rtype: tuple
+    """
+    try:
+        with cybersource_api(key, write_date, configuration,
+                             api_name) as api_client:
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(0.5 * 2 ** (attempt - 1))
+                try:
+                    limiter.wait()
+                    _return_data, status, body = getattr(api_client, method)(
+                        *args, _request_timeout=timeout)
+                except Exception as e:
+                    # The SDK raises ApiException, carrying the response, on
+                    # HTTP errors
+                    status, body = getattr(e, 'status', None), getattr(e, 'body', None)
+                    body = body or json.dumps({'message': str(e)})
+                if status not in CYBERSOURCE_RETRY_STATUSES:
+                    break
+    except Exception as e:
+        # The client could not be built
+        status, body = None, json.dumps({'message': str(e)})
+    return status, _parse_response_body(body)
+
+
 class PaymentTransaction(models.Model):
     """ Inherits payment.transaction """
     _inherit = 'payment.transaction'
@@ -20,7 +142,35 @@ class PaymentTransaction(models.Model):
     cybersource_device_fingerprint = fields.Char(string="Device Fingerprint",
                                                help="Device fingerprint ID used for fraud detection")
     cybersource_approval_code = fields.Char(string="CyberSource Approval Code",
+                                          index='btree_not_null',
                                           help="Approval code returned by CyberSource")
+    cybersource_payment_id = fields.Char(string="CyberSource Payment ID",
+                                         index='btree_not_null',
+                                         help="Identifier of the payment at CyberSource, used for captures, refunds and reversals")
+    cybersource_reconciliation_state = fields.Selection(
+        [('matched', 'Matched'), ('amount', 'Amount Mismatch'),
+         ('state', 'State Mismatch')],
+        string="CyberSource Reconciliation",
+        help="Outcome of the last CyberSource report import for this transaction")
+    cybersource_reported_amount = fields.Float(
+        string="CyberSource Reported Amount",
+        help="Amount of the transaction in the last imported CyberSource report")
+    cybersource_sent_date = fields.Datetime(
+        string="CyberSource Request Sent On", readonly=True, copy=False,
+        help="Time the authorization, refund or token payment was sent, "
+             "marking it in flight until its outcome is known")
+    cybersource_attempts = fields.Integer(string="CyberSource Attempts",
+                                          help="Number of authorization requests sent to CyberSource, 3D Secure retries included")
+
+    def _auto_init(self):
+        """ Index the provider references, by which transactions are matched
+        against CyberSource reports """
+        res = super()._auto_init()
+        create_index(
+            self._cr, 'payment_transaction_provider_reference_index',
+            self._table, ['provider_reference'],
+            where="provider_reference IS NOT NULL")
+        return res
 
     def action_cybersource_set_done(self):
         """ Set the state of the transaction to 'done'."""
@@ -43,6 +193,927 @@ class PaymentTransaction(models.Model):
                              'simulated_state': 'error'}
         self._handle_notification_data('cybersource', notification_data)
 
+    @api.model
+    def _cybersource_claim_authorization(self, reference):
+        """ Make sure a transaction is authorized only once, whatever the
+        number of identical requests (double clicks, browser retries). The
+        transaction row is locked while it is claimed, then marked in flight
+        and committed before the authorization is sent, so that the mark
+        survives a request failing without response and duplicates are
+        answered locally. An authorization left in flight past the timeout is
+        searched at CyberSource before being sent again.
+
+        :param str reference: The reference of the transaction
+        :return: None when the authorization may be sent, otherwise the
+                 response to return for the duplicate request
+        :rtype: dict
+        """
+        tx = self.search([('reference', '=', reference),
+                          ('provider_code', '=', 'cybersource')], limit=1)
+        if not tx:
+            return None
+        try:
+            with self.env.cr.savepoint(flush=False), mute_logger('odoo.sql_db'):
+                self.env.cr.execute(
+                    'SELECT id FROM payment_transaction WHERE id = %s FOR UPDATE NOWAIT',
+                    [tx.id])
+        except LockNotAvailable:
+            _logger.info("Authorization of %s already in progress", reference)
+            return {'status': 'processing', 'reference': reference}
+        tx.invalidate_recordset()
+        if tx.state != 'draft' or tx.cybersource_payment_id:
+            _logger.info("Authorization of %s already processed", reference)
+            return {'status': 'duplicate', 'reference': reference,
+                    'state': tx.state}
+        now = fields.Datetime.now()
+        if tx.cybersource_sent_date:
+            if tx.cybersource_sent_date > now - CYBERSOURCE_IN_FLIGHT_TIMEOUT:
+                return {'status': 'processing', 'reference': reference}
+            found = tx._cybersource_search_authorization()
+            if found is None:
+                return {'status': 'processing', 'reference': reference}
+            if found:
+                return {'status': 'duplicate', 'reference': reference,
+                        'state': tx.state}
+        tx.cybersource_sent_date = now
+        self.env.cr.commit()
+        return None
+
+    def _cybersource_search_authorization(self):
+        """ Search at CyberSource the authorization of a transaction left in
+        flight, applying it when found
+
+        :return: True if an accepted authorization was found and applied,
+                 False if the authorization may be sent again, None while
+                 its outcome cannot be known yet
+        """
+        provider = self.provider_id
+        try:
+            with provider._cybersource_get_api('SearchTransactionsApi') as search_api:
+                _return_data, status, body = search_api.create_search(
+                    utils.serialize_payload(utils.build_search_payload(self.reference)),
+                    _request_timeout=provider._cybersource_get_timeout())
+        except Exception as e:
+            _logger.warning("Search of the authorization of %s failed: %s",
+                            self.reference, e)
+            return None
+        result = utils.get_search_result(json.loads(body) if body else {},
+                                         'ics_auth')
+        if not result:
+            if self.cybersource_sent_date > fields.Datetime.now() - CYBERSOURCE_SEARCH_DELAY:
+                return None
+            _logger.info("Authorization of %s never reached CyberSource",
+                         self.reference)
+            return False
+        summary, succeeded = result
+        if not succeeded:
+            return False
+        _logger.info("Authorization of %s found at CyberSource as %s",
+                     self.reference, summary.get('id'))
+        self._cybersource_apply_authorization(summary, {'reference': self.reference})
+        return True
+
+    @api.model
+    def _cybersource_release_claim(self, reference):
+        """ Remove the in-flight mark committed by the claim of an
+        authorization that could not be sent, so that it is not searched
+        before being sent again """
+        tx = self.search([('reference', '=', reference)], limit=1)
+        if tx.cybersource_sent_date:
+            tx.cybersource_sent_date = False
+            self.env.cr.commit()
+
+    @api.model
+    def _cybersource_apply_authorization(self, response_data,
+                                         notification_values, attempts=1):
+        """ Apply an accepted authorization, which is no longer in flight.
+        Should this fail, the payment id is kept and the transaction set
+        pending, so that it is never sent again and the status check applies
+        the decision of CyberSource later.
+        """
+        tx = self.search([('reference', '=', notification_values.get('reference'))],
+                         limit=1)
+        tx.cybersource_sent_date = False
+        try:
+            with self.env.cr.savepoint():
+                self._handle_notification_data(
+                    'cybersource', self._cybersource_get_notification_data(
+                        response_data, notification_values, attempts))
+        except Exception:
+            _logger.exception("Authorization of %s accepted by CyberSource but "
+                              "not applied, left pending",
+                              notification_values.get('reference'))
+            tx.write({'cybersource_payment_id': response_data.get('id'),
+                      'cybersource_attempts': attempts})
+            tx._set_pending(state_message=_(
+                "Authorized by CyberSource, the outcome is being confirmed."))
+
+    @api.model
+    def _cybersource_apply_refusal(self, response_data, notification_values,
+                                   attempts=1):
+        """ Record an authorization answered but not accepted by CyberSource
+        as an error with its attempts, the authorization being no longer in
+        flight """
+        tx = self.search([('reference', '=', notification_values.get('reference'))],
+                         limit=1)
+        tx.cybersource_sent_date = False
+        self._handle_notification_data('cybersource', dict(
+            notification_values, simulated_state='error', attempts=attempts,
+            message=response_data.get('message') or _("Payment processing error")))
+
+    @api.model
+    def _cybersource_send_payment(self, provider, payload):
+        """ Send an authorization request to CyberSource, adding the 3-D
+        Secure information and retrying when CyberSource requires it. Every
+        attempt reuses the same payload and client, within the attempt budget
+        and deadline of the provider. HTTP errors, a failed 3-D Secure
+        authentication or an exhausted budget are returned as refused
+        responses, so that the caller records the attempts made. A request
+        left without response is returned with a None status; like a server
+        error, its outcome is unknown. Only errors raised before the request
+        was sent raise.
+
+        :param recordset provider: The CyberSource provider
+        :param dict payload: The authorization request
+        :return: The SDK response, HTTP status, parsed response body and
+                 number of attempts
+        :rtype: tuple
+        """
+        timeout = provider._cybersource_get_timeout()
+        max_attempts = max(provider.cyber_max_attempts, 1)
+        deadline = time.monotonic() + (provider.cyber_retry_deadline or 30)
+        use_3ds = 'consumer_authentication_information' in payload
+        attempts = 0
+        with provider._cybersource_get_api('PaymentsApi') as payments_api:
+            while True:
+                attempts += 1
+                start = time.monotonic()
+                try:
+                    return_data, status, body = payments_api.create_payment(
+                        utils.serialize_payload(payload), _request_timeout=timeout)
+                except Exception as e:
+                    # The SDK raises ApiException, carrying the response, on
+                    # HTTP errors. Other errors than transport ones were
+                    # raised before the request was sent.
+                    status, body = getattr(e, 'status', None), getattr(e, 'body', None)
+                    if status is None and not isinstance(e, CYBERSOURCE_TRANSPORT_ERRORS):
+                        raise
+                    status, return_data = status or None, None
+                    body = body or json.dumps({'message': str(e)})
+                # Only unanswered requests and server errors denote an outage
+                provider._cybersource_circuit_record(
+                    utils.is_outcome_unknown(status), time.monotonic() - start)
+                _logger.debug("CyberSource response - Status: %s, Body: %s",
+                              status, body)
+                if status == 201 or CYBERSOURCE_3DS_REQUIRED not in (body or ''):
+                    return return_data, status, _parse_response_body(body), attempts
+                if use_3ds:
+                    return None, status, {'message': _(
+                        "3D Secure authentication failed")}, attempts
+                if attempts >= max_attempts or time.monotonic() >= deadline:
+                    return None, status, {'message': _(
+                        "3D Secure authentication required but the retry budget "
+                        "is exhausted after %s attempts", attempts)}, attempts
+                _logger.info("3D Secure required, retrying with 3D Secure enabled")
+                utils.apply_3ds(payload)
+                use_3ds = True
+
+    @api.model
+    def _cybersource_get_notification_data(self, response_data,
+                                           notification_values, attempts=1):
+        """ Build the notification data of a successful authorization """
+        cybersource_status = response_data.get('status', '')
+        approval_code = response_data.get(
+            'processorInformation', {}).get('approvalCode', '')
+        token_information = response_data.get('tokenInformation', {})
+        network_transaction_id = response_data.get(
+            'processorInformation', {}).get('networkTransactionId', '')
+        _logger.debug("Payment status: %s, approval code: %s",
+                      cybersource_status, approval_code)
+        return dict(
+            notification_values,
+            simulated_state=CYBERSOURCE_STATUS_MAPPING.get(
+                cybersource_status, 'done'),
+            cybersource_status=cybersource_status,
+            message=response_data.get('message', ''),
+            approval_code=approval_code,
+            payment_id=response_data.get('id', ''),
+            customer_token=token_information.get('customer', {}).get('id', ''),
+            instrument_token=token_information.get(
+                'paymentInstrument', {}).get('id', ''),
+            network_transaction_id=network_transaction_id,
+            attempts=attempts,
+        )
+
+    @api.model
+    def _cybersource_authorize_async(self, provider, payload,
+                                     notification_values):
+        """ Queue the authorization on the background pool of this worker.
+
+        :return: False when the pool is saturated and the caller must process
+                 the authorization inline
+        :rtype: bool
+        """
+        executor, slots = _get_async_pool(provider.cyber_async_workers or 4)
+        if not slots.acquire(blocking=False):
+            return False
+        executor.submit(_authorize_in_background, self.env.cr.dbname,
+                        provider.id, payload, notification_values, slots)
+        return True
+
+    @api.model
+    def _cybersource_authorize_and_finalize(self, provider, payload,
+                                            notification_values):
+        """ Send the authorization and record its outcome on the transaction,
+        errors included, as nobody is waiting on the result. An authorization
+        without response or answered by a server error may have been accepted
+        by CyberSource: it stays draft and in flight, to be searched by
+        reference before being sent again. """
+        try:
+            _return_data, status, response_data, attempts = (
+                self._cybersource_send_payment(provider, payload))
+        except Exception as e:
+            _logger.warning("Authorization of %s could not be sent: %s",
+                            notification_values.get('reference'), e)
+            self._cybersource_apply_refusal({'message': str(e)}, notification_values)
+            return
+        if utils.is_outcome_unknown(status):
+            _logger.warning("Authorization of %s got no answer (HTTP status %s), "
+                            "left in flight: %s", notification_values.get('reference'),
+                            status, response_data.get('message'))
+            return
+        if status == 201:
+            self._cybersource_apply_authorization(
+                response_data, notification_values, attempts)
+            return
+        self._cybersource_apply_refusal(response_data, notification_values, attempts)
+
+    def _cybersource_run_batch(self, operation, prepare, apply, commit=False,
+                               retries=0, in_flight=None):
+        """ Run a CyberSource operation on the transactions, in chunks of the
+        provider batch size. The requests of a chunk are sent concurrently by
+        a bounded thread pool, within the provider rate limit, while their
+        results are applied sequentially in this environment. When `commit`
+        is set, each chunk is committed so an interrupted run resumes where it
+        stopped.
+
+        Operations that must not be sent twice give the CyberSource
+        application they run as `in_flight`. Their transactions are then
+        marked in flight, and committed when `commit` is set, before their
+        requests are sent; the mark is removed once CyberSource answered. A
+        transaction still marked, e.g. because the run was interrupted, is
+        searched at CyberSource by reference instead of being sent again.
+
+        :param str operation: The name of the operation, for logs
+        :param str prepare: The name of the transaction method returning the
+                            (api name, method, arguments) of its request, or
+                            None to skip it
+        :param str apply: The name of the transaction method applying the
+                          HTTP status and response data of its request and
+                          returning whether it succeeded
+        :param bool commit: Whether to commit after each chunk
+        :param int retries: The number of retries of a request when
+                            CyberSource is unavailable, for idempotent
+                            requests only
+        :param str in_flight: The CyberSource application of the operation,
+                              e.g. `ics_credit`, to mark its requests in
+                              flight
+        :return: The run statistics
+        :rtype: dict
+        """
+        stats = {'processed': 0, 'succeeded': 0, 'failed': 0, 'skipped': 0}
+        start = time.monotonic()
+        for provider in self.provider_id:
+            transactions = self.filtered(lambda tx: tx.provider_id == provider)
+            key = (self.env.cr.dbname, provider.id)
+            configuration = provider._cybersource_get_configuration()
+            timeout = provider._cybersource_get_timeout()
+            limiter = utils.RateLimiter(provider.cyber_batch_rate_limit)
+            with ThreadPoolExecutor(
+                    max_workers=provider.cyber_batch_workers or 8,
+                    thread_name_prefix='cybersource_%s' % operation) as executor:
+                for chunk_ids in split_every(provider.cyber_batch_size or 100,
+                                             transactions.ids):
+                    calls, searched = {}, self.browse()
+                    for tx in self.browse(chunk_ids):
+                        if in_flight and tx.cybersource_sent_date:
+                            calls[tx] = tx._cybersource_prepare_search()
+                            searched |= tx
+                            continue
+                        call = getattr(tx, prepare)()
+                        if call is None:
+                            stats['skipped'] += 1
+                            continue
+                        calls[tx] = call
+                    if in_flight:
+                        sent = self.browse([tx.id for tx in calls]) - searched
+                        sent.cybersource_sent_date = fields.Datetime.now()
+                        if commit:
+                            self.env.cr.commit()
+                    futures = {
+                        tx: executor.submit(
+                            _call_cybersource, key, provider.write_date,
+                            configuration, timeout, limiter, retries, *call)
+                        for tx, call in calls.items()
+                    }
+                    for tx, future in futures.items():
+                        status, response_data = future.result()
+                        try:
+                            with self.env.cr.savepoint():
+                                if tx in searched:
+                                    succeeded = tx._cybersource_apply_search(
+                                        status, response_data, in_flight, apply)
+                                else:
+                                    # A request without response or answered
+                                    # by a server error may have been
+                                    # processed by CyberSource, it stays in
+                                    # flight
+                                    if in_flight and not utils.is_outcome_unknown(status):
+                                        tx.cybersource_sent_date = False
+                                    succeeded = getattr(tx, apply)(status, response_data)
+                        except Exception:
+                            _logger.exception("CyberSource %s of %s failed",
+                                              operation, tx.reference)
+                            succeeded = False
+                        stats['processed'] += 1
+                        stats['succeeded' if succeeded else 'failed'] += 1
+                    if commit:
+                        self.env.cr.commit()
+        stats['duration'] = time.monotonic() - start
+        stats['rate'] = stats['processed'] / (stats['duration'] or 1)
+        _logger.info(
+            "CyberSource %s: %s transactions processed (%s succeeded, %s failed, "
+            "%s skipped) in %.1fs, %.1f/s", operation, stats['processed'],
+            stats['succeeded'], stats['failed'], stats['skipped'],
+            stats['duration'], stats['rate'])
+        return stats
+
+    def _cybersource_prepare_search(self):
+        """ Return the search request of the transactions sent with the
+        reference of the transaction """
+        return ('SearchTransactionsApi', 'create_search',
+                [utils.serialize_payload(utils.build_search_payload(self.reference))])
+
+    def _cybersource_apply_search(self, status, response_data, application,
+                                  apply):
+        """ Resolve a transaction left in flight from the result of its
+        search at CyberSource. A request found there is applied as if its
+        response had been received; one that is not found once CyberSource
+        had time to index it is released, to be sent again by the next run.
+
+        :param str application: The CyberSource application of the request
+        :param str apply: The name of the method applying its response
+        :return: Whether the request was found and succeeded
+        :rtype: bool
+        """
+        if status != 201:
+            _logger.warning("Search of %s failed - HTTP Status: %s, %s",
+                            self.reference, status, response_data.get('message'))
+            return False
+        result = utils.get_search_result(response_data, application)
+        if not result:
+            if self.cybersource_sent_date < fields.Datetime.now() - CYBERSOURCE_SEARCH_DELAY:
+                _logger.info("%s never reached CyberSource, it will be sent again",
+                             self.reference)
+                self.cybersource_sent_date = False
+            return False
+        summary, succeeded = result
+        _logger.info("%s found at CyberSource as %s (%s)", self.reference,
+                     summary.get('id'), 'accepted' if succeeded else 'refused')
+        self.cybersource_sent_date = False
+        if not succeeded:
+            return getattr(self, apply)(400, {
+                'message': _("Refused by CyberSource")})
+        return getattr(self, apply)(201, summary)
+
+    def _cybersource_capture(self, commit=False):
+        """ Capture the authorized CyberSource transactions in batches """
+        transactions = self.filtered(
+            lambda tx: tx.provider_code == 'cybersource' and tx.state == 'authorized')
+        return transactions._cybersource_run_batch(
+            'capture', '_cybersource_prepare_capture',
+            '_cybersource_apply_capture', commit=commit, in_flight='ics_bill')
+
+    def _cybersource_prepare_capture(self):
+        """ Return the capture request of the transaction """
+        if not self.cybersource_payment_id:
+            _logger.warning("Transaction %s has no CyberSource payment id and "
+                            "cannot be captured", self.reference)
+            return None
+        payload = utils.build_amount_payload(
+            self.reference,
+            float_repr(self.amount, self.currency_id.decimal_places),
+            self.currency_id.name)
+        return ('CaptureApi', 'capture_payment',
+                [utils.serialize_payload(payload), self.cybersource_payment_id])
+
+    def _cybersource_apply_capture(self, status, response_data):
+        """ Set the transaction done once CyberSource accepted the capture. A
+        capture without response or answered by a server error stays
+        authorized and in flight, to be searched before it is sent again. """
+        if utils.is_outcome_unknown(status):
+            _logger.warning("Capture of %s got no answer (HTTP status %s), left "
+                            "in flight: %s", self.reference, status,
+                            response_data.get('message'))
+            return False
+        if status != 201:
+            _logger.warning("Capture of %s refused - HTTP Status: %s, %s",
+                            self.reference, status, response_data.get('message'))
+            return False
+        self._handle_notification_data('cybersource', {
+            'reference': self.reference,
+            'simulated_state': 'done',
+            'manual_capture': True,
+            'cybersource_status': response_data.get('status', ''),
+            'message': response_data.get('message', ''),
+            'approval_code': self.cybersource_approval_code,
+        })
+        return True
+
+    def action_cybersource_capture(self):
+        """ Capture the selected authorized CyberSource transactions """
+        stats = self._cybersource_capture()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'message': _("%(succeeded)s transactions captured, %(failed)s "
+                             "failed, %(skipped)s skipped", **stats),
+                'sticky': False,
+            },
+        }
+
+    @api.model
+    def _cron_cybersource_capture_authorized(self):
+        """ Capture all authorized CyberSource transactions, committing after
+        each batch """
+        self.search([
+            ('provider_code', '=', 'cybersource'),
+            ('state', '=', 'authorized'),
+        ], order='id')._cybersource_capture(commit=True)
+
+    def _send_capture_request(self, amount_to_capture=None):
+        """ Override of `payment` to send the capture request to CyberSource.
+        Only full captures are supported, so no child transaction is created.
+        The in-flight mark is committed before sending; a capture without
+        response is left in flight and searched on the next attempt.
+        """
+        child_capture_tx = super()._send_capture_request(
+            amount_to_capture=amount_to_capture)
+        if self.provider_code != 'cybersource':
+            return child_capture_tx
+        stats = self._cybersource_capture(commit=True)
+        if self.cybersource_sent_date:
+            return child_capture_tx
+        if stats['failed'] or stats['skipped']:
+            raise ValidationError(_("CyberSource: The capture of %s failed.",
+                                    self.reference))
+        return child_capture_tx
+
+    def _cybersource_refund(self, commit=False):
+        """ Send the draft CyberSource refund transactions in batches """
+        transactions = self.filtered(
+            lambda tx: tx.provider_code == 'cybersource'
+            and tx.operation == 'refund' and tx.state == 'draft')
+        return transactions._cybersource_run_batch(
+            'refund', '_cybersource_prepare_refund',
+            '_cybersource_apply_refund', commit=commit, in_flight='ics_credit')
+
+    def _cybersource_prepare_refund(self):
+        """ Return the refund request of the transaction, unless it was
+        already accepted by CyberSource """
+        if self.cybersource_payment_id:
+            return None
+        payment_id = self.source_transaction_id.cybersource_payment_id
+        if not payment_id:
+            _logger.warning("Refund %s has no CyberSource payment to refund",
+                            self.reference)
+            return None
+        payload = utils.build_amount_payload(
+            self.reference,
+            float_repr(-self.amount, self.currency_id.decimal_places),
+            self.currency_id.name)
+        return ('RefundApi', 'refund_payment',
+                [utils.serialize_payload(payload), payment_id])
+
+    def _cybersource_apply_refund(self, status, response_data):
+        """ Set the refund done once CyberSource accepted it. A refund without
+        response or answered by a server error stays draft and in flight, to
+        be searched before it is sent again. """
+        if utils.is_outcome_unknown(status):
+            _logger.warning("Refund %s got no answer (HTTP status %s), left in "
+                            "flight: %s", self.reference, status,
+                            response_data.get('message'))
+            return False
+        if status != 201:
+            _logger.warning("Refund %s refused - HTTP Status: %s, %s",
+                            self.reference, status, response_data.get('message'))
+            return False
+        self._handle_notification_data('cybersource', {
+            'reference': self.reference,
+            'simulated_state': 'done',
+            'cybersource_status': response_data.get('status', ''),
+            'message': response_data.get('message', ''),
+            'payment_id': response_data.get('id', ''),
+        })
+        return True
+
+    def action_cybersource_refund(self):
+        """ Refund the remaining amount of the selected CyberSource payments.
+        The refund transactions are created here and sent by the refund
+        scheduled action, which commits them in chunks. """
+        refund_txs = self.env['payment.transaction']
+        for tx in self.filtered(lambda tx: tx.provider_code == 'cybersource'
+                                and tx.operation != 'refund' and tx.state == 'done'):
+            amount = tx.amount + sum(tx.child_transaction_ids.filtered(
+                lambda child: child.operation == 'refund'
+                and child.state != 'error').mapped('amount'))
+            if tx.currency_id.compare_amounts(amount, 0) > 0:
+                refund_txs |= tx._create_child_transaction(amount, is_refund=True)
+        if refund_txs:
+            self.env.ref('advanced_payment_cybersource.ir_cron_cybersource_refund')._trigger()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'message': _("%s refunds queued", len(refund_txs)),
+                'sticky': False,
+            },
+        }
+
+    @api.model
+    def _cron_cybersource_send_refunds(self):
+        """ Send all draft CyberSource refunds, committing after each batch """
+        self.search([
+            ('provider_code', '=', 'cybersource'),
+            ('operation', '=', 'refund'),
+            ('state', '=', 'draft'),
+        ], order='id')._cybersource_refund(commit=True)
+
+    def _send_refund_request(self, amount_to_refund=None):
+        """ Override of `payment` to send the refund request to CyberSource.
+        The refund and its in-flight mark are committed before sending; a
+        refund without response stays draft and in flight, to be searched by
+        the refund scheduled action. A refund not accepted is set in error. """
+        refund_tx = super()._send_refund_request(amount_to_refund=amount_to_refund)
+        if self.provider_code != 'cybersource':
+            return refund_tx
+        refund_tx._cybersource_refund(commit=True)
+        if refund_tx.state != 'draft' or refund_tx.cybersource_sent_date:
+            return refund_tx
+        refund_tx._set_error(_("CyberSource: The refund was not accepted."))
+        self.env.cr.commit()
+        raise ValidationError(_("CyberSource: The refund of %s failed.",
+                                self.reference))
+
+    def _cybersource_reverse(self, commit=False):
+        """ Reverse the authorized or pending CyberSource transactions in
+        batches, releasing the funds held on the card """
+        transactions = self.filtered(
+            lambda tx: tx.provider_code == 'cybersource'
+            and tx.state in ('authorized', 'pending'))
+        return transactions._cybersource_run_batch(
+            'reversal', '_cybersource_prepare_reversal',
+            '_cybersource_apply_reversal', commit=commit)
+
+    def _cybersource_prepare_reversal(self):
+        """ Return the authorization reversal request of the transaction """
+        if not self.cybersource_payment_id:
+            _logger.warning("Transaction %s has no CyberSource payment id and "
+                            "cannot be reversed", self.reference)
+            return None
+        payload = utils.build_reversal_payload(
+            self.reference,
+            float_repr(self.amount, self.currency_id.decimal_places))
+        return ('ReversalApi', 'auth_reversal',
+                [self.cybersource_payment_id, utils.serialize_payload(payload)])
+
+    def _cybersource_apply_reversal(self, status, response_data):
+        """ Cancel the transaction once CyberSource reversed the
+        authorization """
+        if status != 201:
+            _logger.warning("Reversal of %s refused - HTTP Status: %s, %s",
+                            self.reference, status, response_data.get('message'))
+            return False
+        self._handle_notification_data('cybersource', {
+            'reference': self.reference,
+            'simulated_state': 'cancel',
+            'cybersource_status': response_data.get('status', ''),
+            'message': _("Authorization reversed"),
+            'state_message': _("The authorization was reversed, releasing "
+                               "the funds held on the card."),
+            'approval_code': self.cybersource_approval_code,
+        })
+        return True
+
+    @api.model
+    def _cybersource_run_pages(self, domain, page_size, method, run_limit=0,
+                               deadline=None):
+        """ Run a batch method on the transactions matching the domain, read
+        in keyset pages ordered by id so that each page is found quickly and
+        transactions updated by previous pages are not read again. Each page
+        is committed.
+
+        :param list domain: The domain of the transactions
+        :param int page_size: The number of transactions per page
+        :param str method: The name of the batch method, called with
+                           `commit=True`
+        :param int run_limit: The maximum number of transactions, 0 for all
+        :param float deadline: The monotonic time after which no page is
+                               started
+        :return: The summed statistics of the pages
+        :rtype: dict
+        """
+        stats = {'processed': 0, 'succeeded': 0, 'failed': 0, 'skipped': 0,
+                 'duration': 0.0}
+        last_id = 0
+        while not run_limit or stats['processed'] + stats['skipped'] < run_limit:
+            if deadline and time.monotonic() >= deadline:
+                _logger.info("CyberSource %s stopped, time budget exhausted",
+                             method)
+                break
+            limit = page_size
+            if run_limit:
+                limit = min(limit, run_limit - stats['processed'] - stats['skipped'])
+            transactions = self.search(domain + [('id', '>', last_id)],
+                                       order='id', limit=limit)
+            if not transactions:
+                break
+            last_id = transactions[-1].id
+            page_stats = getattr(transactions, method)(commit=True)
+            for key in stats:
+                stats[key] += page_stats[key]
+        return stats
+
+    @api.model
+    def _cron_cybersource_reverse_stale_authorizations(self):
+        """ Reverse the authorizations left authorized or pending past the
+        age configured on their provider, except those whose capture is in
+        flight """
+        providers = self.env['payment.provider'].search([
+            ('code', '=', 'cybersource'), ('state', '!=', 'disabled'),
+            ('cyber_stale_authorization_days', '>', 0),
+        ])
+        for provider in providers:
+            stats = self._cybersource_run_pages([
+                ('provider_id', '=', provider.id),
+                ('state', 'in', ('authorized', 'pending')),
+                ('operation', '!=', 'refund'),
+                ('cybersource_sent_date', '=', False),
+                ('create_date', '<', fields.Datetime.now() - timedelta(
+                    days=provider.cyber_stale_authorization_days)),
+            ], provider.cyber_batch_size or 100, '_cybersource_reverse',
+                run_limit=provider.cyber_reversal_run_limit)
+            if stats['processed'] or stats['skipped']:
+                _logger.info(
+                    "CyberSource stale authorizations of %s: %s reversed, %s "
+                    "failed, %s skipped in %.1fs", provider.name,
+                    stats['succeeded'], stats['failed'], stats['skipped'],
+                    stats['duration'])
+
+    def _cybersource_reconcile_pending(self, commit=False):
+        """ Fetch the final decision of the pending CyberSource transactions
+        and apply it """
+        transactions = self.filtered(
+            lambda tx: tx.provider_code == 'cybersource' and tx.state == 'pending')
+        return transactions._cybersource_run_batch(
+            'status check', '_cybersource_prepare_status_check',
+            '_cybersource_apply_status_check', commit=commit, retries=3)
+
+    def _cybersource_prepare_status_check(self):
+        """ Return the transaction details request of the transaction """
+        if not self.cybersource_payment_id:
+            return None
+        return ('TransactionDetailsApi', 'get_transaction',
+                [self.cybersource_payment_id])
+
+    def _cybersource_apply_status_check(self, status, response_data):
+        """ Apply the decision found in the transaction details, leaving the
+        transaction pending while CyberSource has not decided """
+        if status != 200:
+            _logger.warning("Status check of %s failed - HTTP Status: %s, %s",
+                            self.reference, status, response_data.get('message'))
+            return False
+        state = utils.get_transaction_decision(response_data)
+        if state:
+            self._handle_notification_data('cybersource', {
+                'reference': self.reference,
+                'simulated_state': state,
+                'cybersource_status': response_data.get(
+                    'applicationInformation', {}).get('status', ''),
+                'message': _("Decision retrieved from CyberSource"),
+                'approval_code': self.cybersource_approval_code,
+            })
+        return True
+
+    @api.model
+    def _cron_cybersource_reconcile_pending(self):
+        """ Resolve the pending CyberSource transactions, within the time
+        budget of each provider """
+        providers = self.env['payment.provider'].search([
+            ('code', '=', 'cybersource'), ('state', '!=', 'disabled'),
+        ])
+        for provider in providers:
+            stats = self._cybersource_run_pages([
+                ('provider_id', '=', provider.id),
+                ('state', '=', 'pending'),
+                ('cybersource_payment_id', '!=', False),
+            ], provider.cyber_batch_size or 100, '_cybersource_reconcile_pending',
+                deadline=time.monotonic() + (provider.cyber_reconcile_time_budget or 300))
+            if stats['processed']:
+                _logger.info(
+                    "CyberSource pending transactions of %s: %s checked, %s "
+                    "failed in %.1fs", provider.name, stats['succeeded'],
+                    stats['failed'], stats['duration'])
+
+    @api.model
+    def _cybersource_import_report(self, report, commit=False, batch_size=1000):
+        """ Reconcile the CyberSource transactions against a transaction
+        detail or settlement report. The report is streamed and its rows are
+        matched, by CyberSource payment id then by reference, against an index
+        built from a single read of the transactions. Outcomes are written on
+        the transactions in batches.
+
+        :param report: The path of the report file or a binary file object
+        :param bool commit: Whether to commit after each batch
+        :param int batch_size: The number of transactions written per batch
+        :return: The import statistics
+        :rtype: dict
+        """
+        start = time.monotonic()
+        by_payment_id, by_reference = {}, {}
+        for tx in self.search_read([('provider_code', '=', 'cybersource')],
+                                   ['reference', 'cybersource_payment_id',
+                                    'amount', 'state']):
+            values = (tx['id'], tx['amount'], tx['state'])
+            by_reference[tx['reference']] = values
+            if tx['cybersource_payment_id']:
+                by_payment_id[tx['cybersource_payment_id']] = values
+        self.env.invalidate_all()
+
+        stats = {'rows': 0, 'matched': 0, 'discrepancies': 0, 'unknown': 0}
+        pending = {}
+        for row in utils.iter_report_rows(report):
+            stats['rows'] += 1
+            tx = (by_payment_id.get(row['request_id'])
+                  or by_reference.get(row['reference']))
+            if not tx:
+                stats['unknown'] += 1
+                _logger.debug("CyberSource report row %s (%s) matches no "
+                              "transaction", row['request_id'], row['reference'])
+                continue
+            tx_id, amount, state = tx
+            reported_amount = row['amount'] if row['amount'] is not None else amount
+            if float_compare(abs(reported_amount), abs(amount), precision_digits=2):
+                reconciliation_state = 'amount'
+            elif state not in ('authorized', 'done'):
+                reconciliation_state = 'state'
+            else:
+                reconciliation_state = 'matched'
+            stats['matched' if reconciliation_state == 'matched'
+                  else 'discrepancies'] += 1
+            pending[tx_id] = {
+                'cybersource_reconciliation_state': reconciliation_state,
+                'cybersource_reported_amount': reported_amount,
+            }
+            if len(pending) >= batch_size:
+                self._cybersource_write_reconciliation(pending, commit)
+                pending = {}
+        self._cybersource_write_reconciliation(pending, commit)
+        stats['duration'] = time.monotonic() - start
+        _logger.info(
+            "CyberSource report imported: %s rows, %s matched, %s discrepancies, "
+            "%s unknown in %.1fs", stats['rows'], stats['matched'],
+            stats['discrepancies'], stats['unknown'], stats['duration'])
+        return stats
+
+    @api.model
+    def _cybersource_write_reconciliation(self, values_by_tx, commit=False):
+        """ Write a batch of reconciliation outcomes and release the cache """
+        for tx_id, values in values_by_tx.items():
+            self.browse(tx_id).write(values)
+        self.env.flush_all()
+        if commit:
+            self.env.cr.commit()
+        self.env.invalidate_all()
+
+    def _send_void_request(self, amount_to_void=None):
+        """ Override of `payment` to reverse the authorization at
+        CyberSource """
+        child_void_tx = super()._send_void_request(amount_to_void=amount_to_void)
+        if self.provider_code != 'cybersource':
+            return child_void_tx
+        stats = self._cybersource_reverse()
+        if stats['failed'] or stats['skipped']:
+            raise ValidationError(_("CyberSource: The reversal of %s failed.",
+                                    self.reference))
+        return child_void_tx
+
+    def _cybersource_tokenize_from_notification_data(self, notification_data):
+        """ Create the payment token of the card stored by CyberSource """
+        token = self.env['payment.token'].create({
+            'provider_id': self.provider_id.id,
+            'payment_method_id': self.payment_method_id.id,
+            'payment_details': notification_data.get('payment_details'),
+            'partner_id': self.partner_id.id,
+            'provider_ref': notification_data['instrument_token'],
+            'cybersource_customer_id': notification_data.get('customer_token'),
+            'cybersource_network_transaction_id': notification_data.get(
+                'network_transaction_id'),
+        })
+        self.write({'token_id': token.id, 'tokenize': False})
+        _logger.info("Created CyberSource token %s for partner %s",
+                     token.id, self.partner_id.id)
+
+    def _send_payment_request(self):
+        """ Override of `payment` to charge the stored CyberSource tokens. The
+        request only carries the tokens and the amount. Like the checkout
+        authorizations, the payment is claimed and committed in flight before
+        being sent: a payment without answer stays draft and in flight, to be
+        searched by reference before being sent again. """
+        super()._send_payment_request()
+        if self.provider_code != 'cybersource':
+            return
+        if not self.token_id:
+            raise ValidationError("CyberSource: " + _("The transaction is not linked to a token."))
+        provider = self.provider_id
+        if not provider._cybersource_circuit_allows():
+            self._set_error(_("Card payments are temporarily unavailable."))
+            return
+        try:
+            if self._cybersource_claim_authorization(self.reference):
+                _logger.info("Token payment %s already sent", self.reference)
+                return
+            _return_data, status, response_data, attempts = (
+                self._cybersource_send_payment(
+                    provider, self._cybersource_get_token_payload()))
+        except Exception as e:
+            # Raised before the payment was sent, which is no longer in flight
+            _logger.error("Token payment %s failed: %s", self.reference, e)
+            self.cybersource_sent_date = False
+            self._cybersource_apply_token_payment(None, {'message': str(e)}, 0)
+            return
+        finally:
+            provider._cybersource_circuit_release()
+        if not utils.is_outcome_unknown(status):
+            self.cybersource_sent_date = False
+        self._cybersource_apply_token_payment(status, response_data, attempts)
+
+    def _cybersource_get_token_payload(self):
+        """ Return the authorization request charging the token of the
+        transaction, merchant initiated unless the customer is paying online
+        """
+        return utils.build_token_payment_payload(
+            self.reference, self.token_id.cybersource_customer_id,
+            self.token_id.provider_ref,
+            float_repr(self.amount, self.currency_id.decimal_places),
+            self.currency_id.name,
+            capture=not self.provider_id.capture_manually,
+            merchant_initiated=self.operation == 'offline',
+            previous_transaction_id=self.token_id.cybersource_network_transaction_id)
+
+    def _cybersource_charge_tokens(self, commit=False):
+        """ Charge the tokens of the draft CyberSource transactions in
+        batches """
+        transactions = self.filtered(
+            lambda tx: tx.provider_code == 'cybersource' and tx.state == 'draft'
+            and tx.token_id)
+        return transactions._cybersource_run_batch(
+            'token payment', '_cybersource_prepare_token_payment',
+            '_cybersource_apply_token_payment', commit=commit, in_flight='ics_auth')
+
+    def _cybersource_prepare_token_payment(self):
+        """ Return the token payment request of the transaction """
+        return ('PaymentsApi', 'create_payment',
+                [utils.serialize_payload(self._cybersource_get_token_payload())])
+
+    def _cybersource_apply_token_payment(self, status, response_data, attempts=1):
+        """ Record the outcome of a token payment on the transaction. A
+        payment sent in flight without response or answered by a server error
+        may have been charged: it stays draft and in flight, to be searched by
+        the next run. """
+        if utils.is_outcome_unknown(status) and self.cybersource_sent_date:
+            _logger.warning("Token payment %s got no answer (HTTP status %s), "
+                            "left in flight: %s", self.reference, status,
+                            response_data.get('message'))
+            return False
+        if status == 201:
+            notification_data = self._cybersource_get_notification_data(
+                response_data, {
+                    'reference': self.reference,
+                    'payment_details': self.token_id.payment_details,
+                    'manual_capture': False,
+                }, attempts)
+        else:
+            notification_data = {
+                'reference': self.reference,
+                'simulated_state': 'error',
+                'attempts': attempts,
+                'message': response_data.get('message') or _("Payment processing error"),
+            }
+        self._handle_notification_data('cybersource', notification_data)
+        return self.state in ('authorized', 'done')
+
     @api.model
     def _get_tx_from_notification_data(self, provider_code, data):
         """ Find the transaction based on the notification data."""
@@ -50,9 +1121,10 @@ class PaymentTransaction(models.Model):
         if provider_code != 'cybersource':
             return tx
         reference = data.get('reference')
-        tx = self.search(
-            [('reference', '=', reference),
-             ('provider_code', '=', 'cybersource')])
+        # References are unique, the provider is checked on the single match
+        tx = self.search([('reference', '=', reference)], limit=1)
+        if tx.provider_code != 'cybersource':
+            tx = self.browse()
         if not tx:
             raise ValidationError(
                 "Cyber Source " + _(
@@ -80,11 +1152,11 @@ class PaymentTransaction(models.Model):
         # Set provider_reference to the approval code if available, otherwise use default format
         if approval_code:
             self.provider_reference = approval_code
-            _logger.info("Set provider_reference to approval code: %s for transaction %s", 
+            _logger.debug("Set provider_reference to approval code: %s for transaction %s", 
                         approval_code, self.reference)
         else:
             self.provider_reference = f'cybersource-{self.reference}'
-            _logger.info("Set provider_reference to default format: cybersource-%s", self.reference)
+            _logger.debug("Set provider_reference to default format: cybersource-%s", self.reference)
         
         # Store CyberSource specific data
         self.cybersource_response_code = notification_data.get('cybersource_status', '')
@@ -93,15 +1165,23 @@ class PaymentTransaction(models.Model):
         # Store device fingerprint if provided
         if notification_data.get('device_fingerprint'):
             self.cybersource_device_fingerprint = notification_data.get('device_fingerprint')
-            _logger.info("Stored device fingerprint: %s", self.cybersource_device_fingerprint)
+            _logger.debug("Stored device fingerprint: %s", self.cybersource_device_fingerprint)
+        
+        # Store the CyberSource payment id if provided
+        if notification_data.get('payment_id'):
+            self.cybersource_payment_id = notification_data['payment_id']
+        
+        # Store the number of authorization attempts if provided
+        if notification_data.get('attempts'):
+            self.cybersource_attempts = notification_data['attempts']
         
         # Store approval code if provided
         if approval_code:
             self.cybersource_approval_code = approval_code
-            _logger.info("Stored approval code: %s", self.cybersource_approval_code)
+            _logger.debug("Stored approval code: %s", self.cybersource_approval_code)
         
         # Log transaction details for debugging
-        _logger.info(
+        _logger.debug(
             "Processing CyberSource transaction %s with state: %s, status: %s, approval_code: %s", 
             self.reference,
             notification_data.get('simulated_state', ''),
@@ -114,22 +1194,23 @@ class PaymentTransaction(models.Model):
         
         if state == 'done':
             # Transaction is successful - either automatically capture or set as authorized
-            if self.capture_manually and not notification_data.get('manual_capture'):
-                _logger.info("Setting transaction %s to authorized", self.reference)
+            if (self.capture_manually and self.operation != 'refund'
+                    and not notification_data.get('manual_capture')):
+                _logger.debug("Setting transaction %s to authorized", self.reference)
                 self._set_authorized()
             else:
-                _logger.info("Setting transaction %s to done", self.reference)
+                _logger.debug("Setting transaction %s to done", self.reference)
                 self._set_done()
                 if self.operation == 'refund':
                     self.env.ref('payment.cron_post_process_payment_tx')._trigger()
         elif state == 'pending':
-            _logger.info("Setting transaction %s to pending", self.reference)
+            _logger.debug("Setting transaction %s to pending", self.reference)
             self._set_pending()
         elif state == 'cancel':
-            _logger.info("Setting transaction %s to canceled", self.reference)
-            self._set_canceled(state_message=f"Payment was declined: {notification_data.get('message', 'No message')}")
+            _logger.debug("Setting transaction %s to canceled", self.reference)
+            self._set_canceled(state_message=notification_data.get('state_message') or f"Payment was declined: {notification_data.get('message', 'No message')}")
         elif state == 'error':
-            _logger.info("Setting transaction %s to error", self.reference)
+            _logger.debug("Setting transaction %s to error", self.reference)
             self._set_error(_(
                 "Payment processing error: %s", 
                 notification_data.get('message', 'Unknown error')
@@ -141,6 +1222,11 @@ class PaymentTransaction(models.Model):
                 state, self.reference
             )
             self._set_error(_("Unexpected payment status"))
+        
+        # Save the card tokens created with a successful payment only
+        if (self.tokenize and notification_data.get('instrument_token')
+                and self.state in ('authorized', 'done')):
+            self._cybersource_tokenize_from_notification_data(notification_data)
     
     def _create_payment(self, **values):
         """Override to add approval code to payment reference"""
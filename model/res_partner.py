@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# XML id of the billing partner used for anonymous payments
+GUEST_PARTNER_XMLID = 'advanced_payment_cybersource.res_partner_payment_guest'
+
+# Values of the CyberSource billing information missing on the partner
+BILL_TO_DEFAULTS = {
+    'first_name': 'Guest',
+    'last_name': 'Customer',
+    'address1': 'Guest Address',
+    'locality': 'Guatemala',
+    'administrative_area': '01',
+    'postal_code': '01007',
+    'country': 'GT',
+    'email': 'payment.guest@example.com',
+    'phone_number': '12345678',
+}
+
+
+class ResPartner(models.Model):
+    """ Inherits res.partner """
+    _inherit = 'res.partner'
+
+    cybersource_auto_charge = fields.Boolean(
+        string="Charge Due Invoices by Card",
+        help="Charge the due invoices of this customer on its saved "
+             "CyberSource card")
+    cybersource_bill_to = fields.Json(
+        string="CyberSource Billing Information",
+        compute='_compute_cybersource_bill_to', store=True,
+        help="Billing information sent to CyberSource with the payments of "
+             "this partner, kept up to date with its address")
+
+    @api.depends('name', 'street', 'city', 'state_id.code', 'zip',
+                 'country_id.code', 'email', 'phone')
+    def _compute_cybersource_bill_to(self):
+        """ Build the `bill_to` of the CyberSource payment requests once per
+        address change, so payments read it in a single field access """
+        for partner in self:
+            name_parts = (partner.name or '').split(' ')
+            values = {
+                'first_name': name_parts[0],
+                'last_name': name_parts[1] if len(name_parts) > 1 else '',
+                'address1': partner.street,
+                'locality': partner.city,
+                'administrative_area': partner.state_id.code,
+                'postal_code': partner.zip,
+                'country': partner.country_id.code,
+                'email': partner.email,
+                'phone_number': partner.phone,
+            }
+            partner.cybersource_bill_to = {
+                key: value or BILL_TO_DEFAULTS[key]
+                for key, value in values.items()
+            }
+
+    @api.model
+    def _cybersource_get_guest_partner(self):
+        """ Return the billing partner of anonymous payments. It is created
+        with the module, so this is a cached XML id lookup; it is only
+        recreated, under a lock, if it has been deleted. """
+        partner = self.env.ref(GUEST_PARTNER_XMLID, raise_if_not_found=False)
+        if partner:
+            return partner.sudo()
+        self.env.cr.execute("SELECT pg_advisory_xact_lock(hashtext(%s))",
+                            [GUEST_PARTNER_XMLID])
+        partner = self.env.ref(GUEST_PARTNER_XMLID, raise_if_not_found=False)
+        if partner:
+            return partner.sudo()
+        values = {
+            'name': 'Payment Guest',
+            'email': 'payment.guest@example.com',
+            'street': 'Guest Address',
+            'city': 'Guatemala',
+            'zip': '01007',
+            'country_id': self.env.ref('base.gt').id,
+            'is_company': False,
+            'customer_rank': 1,
+        }
+        partner = self.sudo()._load_records([{
+            'xml_id': GUEST_PARTNER_XMLID,
+            'values': values,
+            'noupdate': True,
+        }])
+        _logger.info("Created guest partner with ID %s", partner.id)
+        return partner
@@ -197,15 +197,15 @@
             return;
         }
         
-        // Fetch merchant ID and load script
-        fetchMerchantId(function(merchantId) {
-            merchantId = merchantId || 'visanetgt_kani';
+        // Fetch merchant ID and org ID, then load script
+        fetchBootstrap(function(bootstrap) {
+            const merchantId = bootstrap.merchant_id || 'visanetgt_kani';
             const sessionId = merchantId + fingerprint;
             
-            // Determine organization ID based on environment
+            // Organization ID comes from the provider state:
             // k8vif92e = production environment
             // 1snn5n9w = test environment
-            const orgId = getOrganizationId();
+            const orgId = bootstrap.org_id || getOrganizationId();
             
             // Add script tag
             const script = document.createElement('script');
@@ -235,27 +235,26 @@
         });
     }
     
-    function fetchMerchantId(callback) {
-        // Try different methods to get merchant ID
-        if (window.odoo && window.odoo.jsonrpc) {
-            window.odoo.jsonrpc('/payment/cybersource/get_merchant_id', 'call', {})
-                .then(callback)
-                .catch(() => callback(null));
-        } else if (window.fetch) {
-            fetch('/payment/cybersource/get_merchant_id', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    jsonrpc: '2.0',
-                    method: 'call',
-                    params: {}
-                })
-            })
+    function fetchBootstrap(callback) {
+        // Values rendered server-side in the inline payment form
+        const merchantInput = document.getElementById('cybersource_merchant_id');
+        const orgInput = document.getElementById('cybersource_org_id');
+        if (merchantInput && merchantInput.value) {
+            callback({
+                merchant_id: merchantInput.value,
+                org_id: orgInput && orgInput.value,
+            });
+            return;
+        }
+        
+        // Otherwise a single cacheable GET for all checkout values
+        if (window.fetch) {
+            fetch('/payment/cybersource/bootstrap', { credentials: 'same-origin' })
             .then(response => response.json())
-            .then(data => callback(data.result))
-            .catch(() => callback(null));
+            .then(data => callback(data || {}))
+            .catch(() => callback({}));
         } else {
-            callback(null);
+            callback({});
         }
     }
     
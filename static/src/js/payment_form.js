@@ -34,6 +34,41 @@ paymentForm.include({
         return numericId;
     },
 
+    /**
+     * Get the CyberSource merchant ID, from the inline form when rendered
+     * server-side, otherwise from the cacheable bootstrap route
+     * @returns {Promise<String|false>} The merchant ID
+     */
+    _getCyberSourceMerchantId() {
+        const merchantInput = document.getElementById('cybersource_merchant_id');
+        if (merchantInput && merchantInput.value) {
+            return Promise.resolve(merchantInput.value);
+        }
+        return fetch('/payment/cybersource/bootstrap', { credentials: 'same-origin' })
+            .then(response => response.json())
+            .then(data => data.merchant_id)
+            .catch(() => false);
+    },
+
+    /**
+     * Poll the transaction state until the asynchronous authorization is done,
+     * giving up after a minute and leaving the status page to take over
+     * @param {String} reference The transaction reference
+     * @returns {Promise} Resolved once the transaction left the draft state
+     */
+    _waitForCyberSourceResult(reference) {
+        const deadline = Date.now() + 60000;
+        const poll = (delay) => new Promise(resolve => setTimeout(resolve, delay))
+            .then(() => jsonrpc('/payment/cybersource/status', { 'reference': reference }))
+            .then(status => {
+                if (status.final || Date.now() > deadline) {
+                    return status;
+                }
+                return poll(Math.min(delay * 2, 2000));
+            });
+        return poll(250);
+    },
+
     /**
      * Override to handle CyberSource redirect flow
      */
@@ -101,8 +136,9 @@ paymentForm.include({
             }
         }
         
-        // Get merchant ID first
-        return jsonrpc('/payment/cybersource/get_merchant_id')
+        // Merchant ID is rendered in the inline form; only fall back to the
+        // cacheable bootstrap route when it is missing
+        return this._getCyberSourceMerchantId()
         .then(merchant_id => {
             if (merchant_id) {
                 values.merchant_id = merchant_id;
@@ -131,6 +167,12 @@ paymentForm.include({
                 },
             );
         })
+        .then(result => {
+            // Wait for the background authorization when it was queued
+            if (result && result.status === 'processing') {
+                return this._waitForCyberSourceResult(result.reference);
+            }
+        })
         .then(() => {
             // Remove loading indicator if it exists
             $('#payment_processing').remove();
@@ -145,7 +187,8 @@ paymentForm.include({
             console.error("Payment processing error:", error);
             this._displayErrorDialog(
                 _t("Payment Error"),
-                _t("An error occurred while processing your payment. Please try again.")
+                (error.data && error.data.message)
+                    || _t("An error occurred while processing your payment. Please try again.")
             );
         });
     },
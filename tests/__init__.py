@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+from . import test_authorization
+from . import test_batch
+from . import test_checkout
+from . import test_connection_reuse
+from . import test_invoice_charge
+from . import test_provider
+from . import test_token
+from . import test_utils
+from . import test_webhook
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import importlib.util
+import threading
+import time
+from unittest.mock import patch
+
+from odoo.tests import TransactionCase
+from odoo.tools.misc import file_path
+
+CARD = {'number': '4111111111111111', 'exp_month': '12', 'exp_year': '2030',
+        'cvv': '123'}
+BILL_TO = {'first_name': 'Pool', 'last_name': 'Check', 'country': 'US'}
+# Self-signed certificate of 127.0.0.1, trusted by the client in place of
+# the certifi bundle so that its verification stays enabled
+MOCK_CERT = file_path('advanced_payment_cybersource/tests/cybersource_mock_cert.pem')
+MOCK_KEY = file_path('advanced_payment_cybersource/tests/cybersource_mock_key.pem')
+
+
+def load_mock():
+    """ Return the module of tools/cybersource_mock.py """
+    spec = importlib.util.spec_from_file_location(
+        'cybersource_mock',
+        file_path('advanced_payment_cybersource/tools/cybersource_mock.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class CyberSourceMockCommon(TransactionCase):
+    """ CyberSource provider sending its requests over TLS to the local
+    stand-in of tools/cybersource_mock.py """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock = load_mock()
+        cls.server = cls.mock.make_server('127.0.0.1', 0, MOCK_CERT, MOCK_KEY)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+        cls.startClassPatcher(patch('certifi.where', return_value=MOCK_CERT))
+        cls.provider = cls.env.ref(
+            'advanced_payment_cybersource.payment_provider_cybersource')
+        cls.provider.write({
+            'state': 'test',
+            'cyber_merchant': 'pool_check',
+            'cyber_key': '08c94330-f618-42a3-b09d-e1e43be5efda',
+            'cyber_secret_key': 'yBJxy6LjM2TmcPGu+GaJrHtkke25fPpUX+UY6/L/1tE=',
+            'cyber_run_environment': 'https://127.0.0.1:%s' % cls.server.server_port,
+        })
+        cls.payment_method = cls.env.ref(
+            'advanced_payment_cybersource.payment_method_cybersource')
+        cls.partner = cls.env['res.partner'].create({'name': 'Mock Check'})
+
+    def setUp(self):
+        super().setUp()
+        self.provider._cybersource_clear_client_cache()
+        self.addCleanup(self.provider._cybersource_clear_client_cache)
+
+    def _wait_for_mock(self, reference, timeout=5):
+        """ Wait for the mock to process a request of the reference that it
+        answers after the client gave up """
+        deadline = time.monotonic() + timeout
+        while (reference not in self.mock._transactions
+               and time.monotonic() < deadline):
+            time.sleep(0.05)
+
+    def _create_transaction(self, reference, **values):
+        """ Return a draft transaction of the provider """
+        return self.env['payment.transaction'].create(dict({
+            'provider_id': self.provider.id,
+            'payment_method_id': self.payment_method.id,
+            'partner_id': self.partner.id,
+            'amount': 10.0,
+            'currency_id': self.env.ref('base.USD').id,
+            'reference': reference,
+        }, **values))
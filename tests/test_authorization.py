@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.addons.advanced_payment_cybersource import utils
+from odoo.addons.advanced_payment_cybersource.tests.common import BILL_TO, \
+    CARD, CyberSourceMockCommon
+from odoo.tests import tagged
+
+
+@tagged('post_install', '-at_install')
+class TestAuthorization(CyberSourceMockCommon):
+    """ Each transaction is authorized only once, whatever the number of
+    requests sent for it """
+
+    def setUp(self):
+        super().setUp()
+        self.commit = self.startPatcher(patch.object(self.env.cr, 'commit'))
+        self.claim = self.env['payment.transaction']._cybersource_claim_authorization
+
+    def test_claim_duplicate_click(self):
+        tx = self._create_transaction('CLAIM-CLICK')
+        self.assertIsNone(self.claim(tx.reference))
+        self.assertTrue(tx.cybersource_sent_date)
+        self.commit.assert_called_once()
+        self.assertEqual(self.claim(tx.reference),
+                         {'status': 'processing', 'reference': tx.reference})
+        tx._set_done()
+        self.assertEqual(self.claim(tx.reference), {
+            'status': 'duplicate', 'reference': tx.reference, 'state': 'done'})
+        self.commit.assert_called_once()
+
+    def test_claim_still_processing(self):
+        # Sent past the in-flight timeout, but too recently to be searchable
+        sent_date = fields.Datetime.now() - timedelta(minutes=5)
+        tx = self._create_transaction('CLAIM-PROCESSING', cybersource_sent_date=sent_date)
+        self.assertEqual(self.claim(tx.reference),
+                         {'status': 'processing', 'reference': tx.reference})
+        self.assertEqual(tx.cybersource_sent_date, sent_date)
+        self.assertEqual(tx.state, 'draft')
+
+    def test_claim_expired_mark_found(self):
+        tx = self._create_transaction('CLAIM-FOUND', cybersource_sent_date=(
+            fields.Datetime.now() - timedelta(minutes=5)))
+        # The authorization reached CyberSource but its response was lost
+        self.env['payment.transaction']._cybersource_send_payment(
+            self.provider, utils.build_payment_payload(
+                tx.reference, CARD, '10.00', 'USD', BILL_TO, ''))
+        self.assertEqual(self.claim(tx.reference), {
+            'status': 'duplicate', 'reference': tx.reference, 'state': 'done'})
+        self.assertTrue(tx.cybersource_payment_id)
+        self.assertFalse(tx.cybersource_sent_date)
+        self.commit.assert_not_called()
+
+    def test_claim_expired_mark_not_found(self):
+        sent_date = fields.Datetime.now() - timedelta(minutes=20)
+        tx = self._create_transaction('CLAIM-LOST', cybersource_sent_date=sent_date)
+        self.assertIsNone(self.claim(tx.reference))
+        self.assertGreater(tx.cybersource_sent_date, sent_date)
+        self.commit.assert_called_once()
+
+    def _authorize(self, tx):
+        """ Claim and send the authorization of the transaction, as the
+        background pool does """
+        self.assertIsNone(self.claim(tx.reference))
+        self.env['payment.transaction']._cybersource_authorize_and_finalize(
+            self.provider, utils.build_payment_payload(
+                tx.reference, CARD, '10.00', 'USD', BILL_TO, ''),
+            {'reference': tx.reference})
+
+    def test_server_error_leaves_flight(self):
+        tx = self._create_transaction('CLAIM-SERVER-ERROR')
+        # CyberSource processed the authorization but answered a 502
+        with patch.object(self.mock.CyberSourceMockHandler, 'server_error', 502):
+            self._authorize(tx)
+        self.assertEqual(tx.state, 'draft')
+        self.assertTrue(tx.cybersource_sent_date)
+        # Once the mark expired, the authorization is found by its reference
+        # instead of being sent again
+        tx.cybersource_sent_date = fields.Datetime.now() - timedelta(minutes=5)
+        self.assertEqual(self.claim(tx.reference), {
+            'status': 'duplicate', 'reference': tx.reference, 'state': 'done'})
+        self.assertEqual(len(self.mock._transactions[tx.reference]), 1)
+
+    def test_background_authorization_without_response(self):
+        tx = self._create_transaction('CLAIM-ASYNC')
+        with patch.object(type(self.provider), '_cybersource_get_timeout',
+                          return_value=(5, 0.2)), \
+                patch.object(self.mock.CyberSourceMockHandler, 'latency', 1):
+            self._authorize(tx)
+        self.assertEqual(tx.state, 'draft')
+        self.assertTrue(tx.cybersource_sent_date)
+
+    def test_background_authorization_not_sent(self):
+        tx = self._create_transaction('CLAIM-NOT-SENT')
+        with patch.object(type(self.provider), '_cybersource_get_configuration',
+                          side_effect=ValueError("Invalid merchant key")):
+            self._authorize(tx)
+        self.assertRecordValues(tx, [{'state': 'error', 'cybersource_sent_date': False}])
+        self.assertIn("Invalid merchant key", tx.state_message)
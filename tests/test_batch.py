@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.addons.advanced_payment_cybersource.tests.common import \
+    CyberSourceMockCommon
+from odoo.tests import tagged
+
+
+@tagged('post_install', '-at_install')
+class TestBatch(CyberSourceMockCommon):
+    """ Batch engine shared by the captures, refunds and token charges """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.provider.capture_manually = True
+
+    def setUp(self):
+        super().setUp()
+        self.commit = self.startPatcher(patch.object(self.env.cr, 'commit'))
+
+    def _create_authorized(self, reference, **values):
+        return self._create_transaction(reference, **dict({
+            'state': 'authorized',
+            'cybersource_payment_id': reference.replace('-', ''),
+        }, **values))
+
+    def _create_refund(self, reference):
+        source = self._create_transaction(reference, **{
+            'state': 'done',
+            'cybersource_payment_id': reference.replace('-', ''),
+        })
+        return self._create_transaction(reference + '-R', **{
+            'operation': 'refund',
+            'amount': -10.0,
+            'source_transaction_id': source.id,
+        })
+
+    def _assert_refunded_once(self, refund):
+        """ Check that a refund left in flight is found by the next run
+        instead of being sent again """
+        self.assertEqual(refund.state, 'draft')
+        self.assertTrue(refund.cybersource_sent_date)
+        self._wait_for_mock(refund.reference)
+        stats = refund._cybersource_refund(commit=True)
+        self.assertEqual((stats['processed'], stats['succeeded']), (1, 1))
+        self.assertRecordValues(refund, [{'state': 'done', 'cybersource_sent_date': False}])
+        self.assertEqual(len(self.mock._transactions[refund.reference]), 1,
+                         "The refund must be sent only once")
+
+    def test_refund_without_response(self):
+        refund = self._create_refund('BATCH-REFUND-TIMEOUT')
+        with patch.object(type(self.provider), '_cybersource_get_timeout',
+                          return_value=(5, 0.2)), \
+                patch.object(self.mock.CyberSourceMockHandler, 'latency', 1):
+            stats = refund._cybersource_refund(commit=True)
+        self.assertEqual((stats['processed'], stats['failed']), (1, 1))
+        self._assert_refunded_once(refund)
+
+    def test_refund_server_error(self):
+        refund = self._create_refund('BATCH-REFUND-ERROR')
+        # CyberSource processed the refund but answered a 502
+        with patch.object(self.mock.CyberSourceMockHandler, 'server_error', 502):
+            stats = refund._cybersource_refund(commit=True)
+        self.assertEqual((stats['processed'], stats['failed']), (1, 1))
+        self._assert_refunded_once(refund)
+
+    def test_capture_in_chunks(self):
+        self.provider.write({'cyber_batch_size': 2, 'cyber_batch_rate_limit': 20})
+        transactions = self.env['payment.transaction']
+        for index in range(5):
+            transactions |= self._create_authorized('BATCH-CHUNK-%s' % index)
+        stats = transactions._cybersource_capture(commit=True)
+        self.assertEqual(
+            {key: stats[key] for key in ('processed', 'succeeded', 'failed', 'skipped')},
+            {'processed': 5, 'succeeded': 5, 'failed': 0, 'skipped': 0})
+        # 5 requests at 20 per second are spaced over at least 0.2 s
+        self.assertGreaterEqual(stats['duration'], 0.2)
+        self.assertAlmostEqual(stats['rate'], 5 / stats['duration'])
+        self.assertEqual(set(transactions.mapped('state')), {'done'})
+        self.assertFalse(any(transactions.mapped('cybersource_sent_date')))
+        # The in-flight marks, then the outcomes, of each of the 3 chunks
+        self.assertEqual(self.commit.call_count, 6)
+
+    def test_capture_skipped(self):
+        tx = self._create_authorized('BATCH-SKIPPED', cybersource_payment_id=False)
+        stats = tx._cybersource_capture(commit=True)
+        self.assertEqual((stats['processed'], stats['skipped']), (0, 1))
+        self.assertEqual(tx.state, 'authorized')
+
+    def test_reverse_stale_authorizations(self):
+        self.provider.cyber_stale_authorization_days = 7
+        stale = self._create_authorized('BATCH-STALE')
+        capturing = self._create_authorized(
+            'BATCH-STALE-CAPTURING', cybersource_sent_date=fields.Datetime.now())
+        recent = self._create_authorized('BATCH-STALE-RECENT')
+        self.env.flush_all()
+        self.env.cr.execute("""
+            UPDATE payment_transaction SET create_date = %s WHERE id IN %s
+        """, [fields.Datetime.now() - timedelta(days=8), tuple((stale | capturing).ids)])
+        self.env.invalidate_all()
+        self.env['payment.transaction']._cron_cybersource_reverse_stale_authorizations()
+        # The authorization whose capture is in flight is left alone
+        self.assertRecordValues(stale | capturing | recent, [
+            {'state': 'cancel'}, {'state': 'authorized'}, {'state': 'authorized'}])
+        self.assertEqual(stale.state_message, "The authorization was reversed, "
+                                              "releasing the funds held on the card.")
+
+    def test_resume_in_flight(self):
+        now = fields.Datetime.now()
+        found = self._create_authorized(
+            'BATCH-FOUND', cybersource_sent_date=now - timedelta(minutes=20))
+        lost = self._create_authorized(
+            'BATCH-LOST', cybersource_sent_date=now - timedelta(minutes=20))
+        recent = self._create_authorized(
+            'BATCH-RECENT', cybersource_sent_date=now - timedelta(minutes=5))
+        # The capture of `found` reached CyberSource before the run stopped
+        with self.provider._cybersource_get_api('CaptureApi') as capture_api:
+            capture_api.capture_payment(*found._cybersource_prepare_capture()[2])
+        stats = (found | lost | recent)._cybersource_capture(commit=True)
+        self.assertEqual((stats['processed'], stats['succeeded'], stats['failed']),
+                         (3, 1, 2))
+        self.assertRecordValues(found | lost | recent, [
+            {'state': 'done', 'cybersource_sent_date': False},
+            # Not found once searchable: released, to be sent again
+            {'state': 'authorized', 'cybersource_sent_date': False},
+            # Not searchable yet: still in flight
+            {'state': 'authorized', 'cybersource_sent_date': now - timedelta(minutes=5)},
+        ])
+        stats = (lost | recent)._cybersource_capture(commit=True)
+        self.assertEqual((stats['processed'], stats['succeeded']), (2, 1))
+        self.assertEqual(lost.state, 'done')
+        self.assertEqual(recent.state, 'authorized')
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.addons.advanced_payment_cybersource.tests.common import CARD, \
+    CyberSourceMockCommon
+from odoo.tests import HttpCase, tagged
+from odoo.tools import mute_logger
+
+# Card for which the mock requires 3-D Secure data
+CARD_3DS = '4000000000000004'
+CONTROLLER = 'odoo.addons.advanced_payment_cybersource.controllers.advanced_payment_cybersource'
+
+
+@tagged('post_install', '-at_install')
+class TestCheckout(CyberSourceMockCommon, HttpCase):
+    """ Payment route called by the checkout form """
+
+    def _pay(self, **params):
+        """ Call the payment route and return its JSON-RPC response """
+        self.env.flush_all()
+        return self.url_open('/payment/cybersource/simulate_payment', data=json.dumps({
+            'jsonrpc': '2.0', 'method': 'call', 'id': 1, 'params': params,
+        }), headers={'Content-Type': 'application/json'}).json()
+
+    def _pay_transaction(self, tx, card_number):
+        """ Pay the transaction with the card through the payment route """
+        response = self._pay(reference=tx.reference, customer_input={
+            'card_num': card_number, 'exp_month': '12', 'exp_year': '2030',
+            'cvv': '123', 'device_fingerprint': '',
+        }, values={
+            'amount': '10.00', 'currency': tx.currency_id.id,
+            'partner': tx.partner_id.id, 'merchant_id': self.provider.cyber_merchant,
+        })
+        tx.invalidate_recordset()
+        return response
+
+    def test_circuit_open(self):
+        self.provider.cyber_circuit_open_until = fields.Datetime.now() + timedelta(minutes=1)
+        error = self._pay(reference='CIRCUIT-CHECK')['error']['data']
+        self.assertEqual(error['name'], 'odoo.exceptions.ValidationError')
+        self.assertIn("Card payments are temporarily unavailable", error['message'])
+
+    def test_3ds_retry_budget_exhausted(self):
+        self.provider.cyber_max_attempts = 1
+        tx = self._create_transaction('3DS-BUDGET')
+        result = self._pay_transaction(tx, CARD_3DS)['result']
+        self.assertEqual(result['status'], 'error')
+        self.assertIn("retry budget is exhausted after 1 attempts", result['message'])
+        self.assertRecordValues(tx, [{'state': 'error', 'cybersource_attempts': 1}])
+
+    def test_3ds_retry(self):
+        self.provider.cyber_max_attempts = 2
+        tx = self._create_transaction('3DS-RETRY')
+        self.assertNotIn('error', self._pay_transaction(tx, CARD_3DS))
+        self.assertRecordValues(tx, [{'state': 'done', 'cybersource_attempts': 2}])
+        self.assertTrue(tx.cybersource_payment_id)
+
+    def test_3ds_retry_deadline(self):
+        self.provider.write({'cyber_max_attempts': 2, 'cyber_retry_deadline': 1})
+        tx = self._create_transaction('3DS-DEADLINE')
+        # The first answer comes after the deadline, no retry is started
+        with patch.object(self.mock.CyberSourceMockHandler, 'latency', 2):
+            result = self._pay_transaction(tx, CARD_3DS)['result']
+        self.assertEqual(result['status'], 'error')
+        self.assertRecordValues(tx, [{'state': 'error', 'cybersource_attempts': 1}])
+
+    def test_server_error(self):
+        tx = self._create_transaction('SERVER-ERROR')
+        # CyberSource processed the payment but answered a 502
+        with patch.object(self.mock.CyberSourceMockHandler, 'server_error', 502):
+            result = self._pay_transaction(tx, CARD['number'])['result']
+        self.assertEqual(result, {'status': 'processing', 'reference': tx.reference})
+        self.assertEqual(tx.state, 'draft')
+        self.assertTrue(tx.cybersource_sent_date)
+        # Paid again once the mark expired, the payment is found by its
+        # reference instead of being sent again
+        tx.cybersource_sent_date = fields.Datetime.now() - timedelta(minutes=5)
+        result = self._pay_transaction(tx, CARD['number'])['result']
+        self.assertEqual(result, {
+            'status': 'duplicate', 'reference': tx.reference, 'state': 'done'})
+        self.assertEqual(len(self.mock._transactions[tx.reference]), 1)
+
+    @mute_logger(CONTROLLER)
+    def test_client_error(self):
+        tx = self._create_transaction('CLIENT-ERROR')
+        with patch.object(type(self.provider), '_cybersource_get_configuration',
+                          side_effect=ValueError("Invalid merchant key")):
+            error = self._pay_transaction(tx, CARD['number'])['error']['data']
+        self.assertIn("Invalid merchant key", error['message'])
+        self.assertRecordValues(tx, [{'state': 'draft', 'cybersource_sent_date': False}])
+
+    @mute_logger(CONTROLLER)
+    def test_send_error_releases_claim(self):
+        tx = self._create_transaction('SEND-ERROR')
+        with patch.object(type(self.env['payment.transaction']),
+                          '_cybersource_send_payment',
+                          side_effect=TypeError("Invalid payload")):
+            error = self._pay_transaction(tx, CARD['number'])['error']['data']
+        self.assertIn("Invalid payload", error['message'])
+        self.assertRecordValues(tx, [{'state': 'draft', 'cybersource_sent_date': False}])
+        self.assertNotIn(tx.reference, self.mock._transactions)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from odoo.addons.advanced_payment_cybersource import utils
+from odoo.addons.advanced_payment_cybersource.model.payment_provider import \
+    cybersource_api
+from odoo.addons.advanced_payment_cybersource.tests.common import BILL_TO, \
+    CARD, CyberSourceMockCommon
+from odoo.tests import tagged
+
+
+@tagged('post_install', '-at_install')
+class TestConnectionReuse(CyberSourceMockCommon):
+    """ Payments sent one after the other share a single TLS connection """
+
+    def _get_mock_pool_stats(self):
+        return [stats for stats in self.provider._cybersource_get_pool_stats()
+                if stats['port'] == self.server.server_port]
+
+    def test_payments_reuse_the_tls_connection(self):
+        payments = 10
+        tx_model = self.env['payment.transaction']
+        for index in range(payments):
+            payload = utils.build_payment_payload(
+                'POOL-CHECK-%s' % index, CARD, '10.00', 'USD', BILL_TO, '')
+            status = tx_model._cybersource_send_payment(self.provider, payload)[1]
+            self.assertEqual(status, 201)
+        stats = self._get_mock_pool_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['host'], '127.0.0.1')
+        self.assertEqual(stats[0]['open_connections'], 1,
+                         "All payments must share one connection")
+        self.assertEqual(stats[0]['requests'], payments)
+        self.assertEqual(stats[0]['max_connections'], self.provider.cyber_pool_size or 10)
+
+    def test_threads_share_the_client(self):
+        # Each request of the threaded server runs in a thread of its own
+        key = (self.env.cr.dbname, self.provider.id)
+        write_date = self.provider.write_date
+        configuration = self.provider._cybersource_get_configuration()
+        clients = []
+
+        def pay(reference):
+            with cybersource_api(key, write_date, configuration,
+                                 'PaymentsApi') as payments_api:
+                clients.append(payments_api)
+                payments_api.create_payment(utils.serialize_payload(
+                    utils.build_payment_payload(
+                        reference, CARD, '10.00', 'USD', BILL_TO, '')),
+                    _request_timeout=(5, 30))
+
+        for index in range(2):
+            thread = threading.Thread(target=pay, args=('THREAD-CHECK-%s' % index,))
+            thread.start()
+            thread.join()
+        self.assertEqual(len(clients), 2)
+        self.assertIs(clients[0], clients[1])
+        stats = self._get_mock_pool_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0]['open_connections'], stats[0]['requests']), (1, 2),
+                         "Both threads must share one connection")
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from odoo.addons.advanced_payment_cybersource.tests.common import \
+    CyberSourceMockCommon
+from odoo.tests import tagged
+
+
+@tagged('post_install', '-at_install')
+class TestInvoiceCharge(CyberSourceMockCommon, AccountTestInvoicingCommon):
+    """ Due invoices charged on the saved cards of their customers """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.provider.company_id = cls.company_data['company']
+        cls.partner.cybersource_auto_charge = True
+        cls.env['payment.token'].create({
+            'provider_id': cls.provider.id,
+            'payment_method_id': cls.payment_method.id,
+            'partner_id': cls.partner.id,
+            'provider_ref': 'F1D0C2B3A4958677',
+            'payment_details': '1111',
+            'cybersource_customer_id': 'E0D1C2B3A4958677',
+        })
+
+    def setUp(self):
+        super().setUp()
+        self.startPatcher(patch.object(self.env.cr, 'commit'))
+        self.invoice = self.init_invoice(
+            'out_invoice', partner=self.partner,
+            invoice_date=fields.Date.context_today(self.partner),
+            amounts=[100.0], post=True)
+
+    def _assert_charged_once(self):
+        """ Check that the charge left in flight is found by the next run
+        instead of being sent again """
+        tx = self.invoice.transaction_ids
+        self.assertEqual(len(tx), 1)
+        self.assertEqual(tx.state, 'draft')
+        self.assertTrue(tx.cybersource_sent_date)
+        self._wait_for_mock(tx.reference)
+        self.env['account.move']._cron_cybersource_charge_due_invoices()
+        self.assertEqual(self.invoice.transaction_ids, tx)
+        self.assertRecordValues(tx, [{'state': 'done', 'cybersource_sent_date': False}])
+        self.assertEqual(len(self.mock._transactions[tx.reference]), 1,
+                         "The invoice must be charged only once")
+
+    def test_charge_without_response(self):
+        with patch.object(type(self.provider), '_cybersource_get_timeout',
+                          return_value=(5, 0.2)), \
+                patch.object(self.mock.CyberSourceMockHandler, 'latency', 1):
+            self.env['account.move']._cron_cybersource_charge_due_invoices()
+        self._assert_charged_once()
+
+    def test_charge_server_error(self):
+        # CyberSource charged the card but answered a 502
+        with patch.object(self.mock.CyberSourceMockHandler, 'server_error', 502):
+            self.env['account.move']._cron_cybersource_charge_due_invoices()
+        self._assert_charged_once()
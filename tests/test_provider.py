@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import TransactionCase, tagged
+
+
+@tagged('post_install', '-at_install')
+class TestProviderLookup(TransactionCase):
+    """ Cached lookup of the CyberSource provider of the checkout """
+
+    def test_lookup_follows_provider_changes(self):
+        provider = self.env.ref(
+            'advanced_payment_cybersource.payment_provider_cybersource')
+        provider.write({'state': 'test', 'sequence': 10})
+        other = provider.copy({'name': 'CyberSource Shop', 'state': 'test',
+                               'sequence': 20})
+        lookup = self.env['payment.provider']._cybersource_get_provider
+        self.assertEqual(lookup(), provider)
+        other.sequence = 5
+        self.assertEqual(lookup(), other)
+        website = self.env['website'].create({'name': 'CyberSource Shop'})
+        other.website_id = website
+        self.assertEqual(lookup(), provider)
+        self.assertEqual(lookup(website_id=website.id), other)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.addons.advanced_payment_cybersource import utils
+from odoo.addons.advanced_payment_cybersource.tests.common import BILL_TO, \
+    CARD, CyberSourceMockCommon
+from odoo.tests import tagged
+
+
+@tagged('post_install', '-at_install')
+class TestToken(CyberSourceMockCommon):
+    """ Cards saved as CyberSource tokens with the payment storing them """
+
+    def _pay_and_save(self, tx, card_number):
+        """ Authorize the transaction, asking CyberSource to store the card """
+        tx_model = self.env['payment.transaction']
+        payload = utils.apply_token_creation(utils.build_payment_payload(
+            tx.reference, dict(CARD, number=card_number), '10.00', 'USD',
+            BILL_TO, ''))
+        _return_data, status, response_data, attempts = (
+            tx_model._cybersource_send_payment(self.provider, payload))
+        self.assertEqual(status, 201)
+        tx_model._cybersource_apply_authorization(response_data, {
+            'reference': tx.reference, 'payment_details': card_number[-4:],
+        }, attempts)
+
+    def test_card_saved_with_accepted_payment(self):
+        tx = self._create_transaction('TOKEN-ACCEPTED', tokenize=True)
+        self._pay_and_save(tx, CARD['number'])
+        self.assertEqual(tx.state, 'done')
+        self.assertTrue(tx.token_id.provider_ref)
+        self.assertTrue(tx.token_id.cybersource_customer_id)
+        self.assertFalse(tx.tokenize)
+
+    def test_card_not_saved_with_declined_payment(self):
+        tx = self._create_transaction('TOKEN-DECLINED', tokenize=True)
+        self._pay_and_save(tx, '4000000000000002')
+        self.assertEqual(tx.state, 'cancel')
+        self.assertFalse(tx.token_id)
+        self.assertFalse(self.env['payment.token'].search(
+            [('partner_id', '=', self.partner.id)]))
+
+    def _create_token_transaction(self, reference):
+        token = self.env['payment.token'].create({
+            'provider_id': self.provider.id,
+            'payment_method_id': self.payment_method.id,
+            'partner_id': self.partner.id,
+            'provider_ref': 'F1D0C2B3A4958677',
+            'payment_details': '1111',
+            'cybersource_customer_id': 'E0D1C2B3A4958677',
+        })
+        return self._create_transaction(reference, token_id=token.id,
+                                        operation='offline')
+
+    def test_token_payment(self):
+        self.startPatcher(patch.object(self.env.cr, 'commit'))
+        tx = self._create_token_transaction('TOKEN-PAYMENT')
+        tx._send_payment_request()
+        self.assertRecordValues(tx, [{'state': 'done', 'cybersource_sent_date': False}])
+        self.assertTrue(tx.cybersource_payment_id)
+
+    def test_token_payment_server_error(self):
+        self.startPatcher(patch.object(self.env.cr, 'commit'))
+        tx = self._create_token_transaction('TOKEN-SERVER-ERROR')
+        # CyberSource charged the card but answered a 502
+        with patch.object(self.mock.CyberSourceMockHandler, 'server_error', 502):
+            tx._send_payment_request()
+        self.assertEqual(tx.state, 'draft')
+        self.assertTrue(tx.cybersource_sent_date)
+        # Sent again while in flight, nothing is sent
+        tx._send_payment_request()
+        self.assertEqual(tx.state, 'draft')
+        # Once the mark expired, the payment is found by its reference
+        tx.cybersource_sent_date = fields.Datetime.now() - timedelta(minutes=5)
+        tx._send_payment_request()
+        self.assertRecordValues(tx, [{'state': 'done', 'cybersource_sent_date': False}])
+        self.assertEqual(len(self.mock._transactions[tx.reference]), 1,
+                         "The card must be charged only once")
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+from odoo.addons.advanced_payment_cybersource import utils
+from odoo.tests.common import BaseCase, tagged
+
+CARD = {'number': '4111111111111111', 'exp_month': '12', 'exp_year': '2030',
+        'cvv': '123'}
+BILL_TO = {'first_name': 'John', 'last_name': 'Doe', 'country': 'US'}
+
+
+def summary(application, r_code, payment_id='1'):
+    return {'id': payment_id, 'applicationInformation': {
+        'applications': [{'name': application, 'rCode': r_code}]}}
+
+
+@tagged('post_install', '-at_install')
+class TestUtils(BaseCase):
+    """ Pure helpers building and reading the CyberSource messages """
+
+    def test_iter_report_rows_csv(self):
+        report = io.BytesIO((
+            "Transaction Detail Report,1.0\r\n"
+            "Report Start Date,2024-01-01\r\n"
+            "request_id,merchant_ref_number,amount,currency\r\n"
+            "7000000000000000000001,S00001,\"1,234.50\",USD\r\n"
+            "7000000000000000000002,S00002,,USD\r\n"
+        ).encode('utf-8-sig'))
+        self.assertEqual(list(utils.iter_report_rows(report)), [
+            {'request_id': '7000000000000000000001', 'reference': 'S00001',
+             'amount': 1234.5, 'currency': 'USD'},
+            {'request_id': '7000000000000000000002', 'reference': 'S00002',
+             'amount': None, 'currency': 'USD'},
+        ])
+        self.assertFalse(report.closed)
+
+    def test_iter_report_rows_xml(self):
+        report = io.BytesIO(
+            b'<?xml version="1.0" encoding="utf-8"?>\n'
+            b'<Report xmlns="https://ebc.cybersource.com/ebc/reports/dtd/tdr_1_1.dtd">'
+            b'<Requests>'
+            b'<Request RequestID="7000000000000000000001" MerchantReferenceNumber="S00001">'
+            b'<PaymentData><Amount>10.00</Amount><Currency>USD</Currency></PaymentData>'
+            b'</Request>'
+            b'<Request RequestID="7000000000000000000002" MerchantReferenceNumber="S00002"/>'
+            b'</Requests></Report>')
+        self.assertEqual(list(utils.iter_report_rows(report)), [
+            {'request_id': '7000000000000000000001', 'reference': 'S00001',
+             'amount': 10.0, 'currency': 'USD'},
+            {'request_id': '7000000000000000000002', 'reference': 'S00002',
+             'amount': None, 'currency': ''},
+        ])
+
+    def test_get_search_result(self):
+        refused, accepted = summary('ics_credit', '0', '2'), summary('ics_credit', '1', '1')
+        response_data = {'_embedded': {'transactionSummaries': [
+            summary('ics_auth', '1', '3'), refused, accepted]}}
+        self.assertEqual(utils.get_search_result(response_data, 'ics_credit'),
+                         (refused, False))
+        self.assertEqual(utils.get_search_result(response_data, 'ics_auth'),
+                         (response_data['_embedded']['transactionSummaries'][0], True))
+        self.assertIsNone(utils.get_search_result(response_data, 'ics_bill'))
+        self.assertIsNone(utils.get_search_result({}, 'ics_auth'))
+
+    def test_get_transaction_decision(self):
+        self.assertEqual(utils.get_transaction_decision(
+            {'riskInformation': {'profile': {'decision': 'reject'}}}), 'cancel')
+        self.assertIsNone(utils.get_transaction_decision(
+            dict(summary('ics_auth', '1'),
+                 riskInformation={'profile': {'decision': 'REVIEW'}})))
+        self.assertEqual(utils.get_transaction_decision(
+            summary('ics_auth', '1')), 'done')
+        self.assertEqual(utils.get_transaction_decision(
+            summary('ics_auth', '0')), 'cancel')
+        self.assertEqual(utils.get_transaction_decision(
+            summary('ics_auth', '-1')), 'cancel')
+        self.assertIsNone(utils.get_transaction_decision(
+            summary('ics_bill', '1')))
+        self.assertIsNone(utils.get_transaction_decision({}))
+
+    def test_build_payment_payload(self):
+        payload = utils.build_payment_payload(
+            'S00001', CARD, '10.00', 'USD', BILL_TO, 'merchant-session',
+            capture=False)
+        self.assertEqual(payload['client_reference_information'], {'code': 'S00001'})
+        self.assertEqual(payload['processing_information'], {'capture': False})
+        self.assertEqual(payload['payment_information']['tokenized_card'], {
+            'number': '4111111111111111',
+            'expiration_month': '12',
+            'expiration_year': '2030',
+            'security_code': '123',
+            'transaction_type': '1',
+        })
+        self.assertEqual(payload['order_information'], {
+            'amount_details': {'total_amount': '10.00', 'currency': 'USD'},
+            'bill_to': BILL_TO,
+        })
+        self.assertNotIn('consumer_authentication_information', payload)
+        self.assertEqual(json.loads(utils.serialize_payload(payload)), payload)
+
+        payload = utils.build_payment_payload(
+            'S00001', CARD, '10.00', 'USD', BILL_TO, '', use_3ds=True)
+        self.assertEqual(payload['processing_information'],
+                         {'capture': True, 'commerce_indicator': 'vbv'})
+        self.assertEqual(set(payload['consumer_authentication_information']),
+                         {'cavv', 'xid'})
+
+    def test_mask_payload(self):
+        payload = utils.build_payment_payload(
+            'S00001', CARD, '10.00', 'USD', BILL_TO, '')
+        masked = utils.mask_payload(payload)
+        card = masked['payment_information']['tokenized_card']
+        self.assertEqual(card['number'], 'XXXX1111')
+        self.assertEqual(card['security_code'], 'XXX')
+        self.assertEqual(card['expiration_year'], '2030')
+        self.assertEqual(masked['order_information'], payload['order_information'])
+        # The request itself is left untouched
+        card = payload['payment_information']['tokenized_card']
+        self.assertEqual(card['number'], '4111111111111111')
+        self.assertEqual(card['security_code'], '123')
+        amount_payload = utils.build_amount_payload('S00001', '10.00', 'USD')
+        self.assertIs(utils.mask_payload(amount_payload), amount_payload)
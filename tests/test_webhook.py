@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import TransactionCase, tagged
+
+WEBHOOK_SECRET = base64.b64encode(b'cybersource-webhook-secret').decode()
+
+
+@tagged('post_install', '-at_install')
+class TestWebhook(TransactionCase):
+    """ Signature check and inbox processing of the CyberSource webhooks """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.provider = cls.env.ref(
+            'advanced_payment_cybersource.payment_provider_cybersource')
+        cls.provider.cyber_webhook_secret = WEBHOOK_SECRET
+        cls.event_model = cls.env['payment.cybersource.event']
+        cls.tx = cls.env['payment.transaction'].create({
+            'provider_id': cls.provider.id,
+            'payment_method_id': cls.env.ref(
+                'advanced_payment_cybersource.payment_method_cybersource').id,
+            'partner_id': cls.env['res.partner'].create({'name': 'Event Check'}).id,
+            'amount': 10.0,
+            'currency_id': cls.env.ref('base.USD').id,
+            'reference': 'EVENT-CHECK',
+            'cybersource_payment_id': '7000000000000000000001',
+            'state': 'pending',
+        })
+
+    def _sign(self, body, timestamp=None, secret=WEBHOOK_SECRET):
+        timestamp = str(int(time.time()) if timestamp is None else timestamp)
+        signature = base64.b64encode(hmac.new(
+            base64.b64decode(secret), timestamp.encode() + b'.' + body,
+            hashlib.sha256).digest()).decode()
+        return 't=%s;keyId=webhook-key;sig=%s' % (timestamp, signature)
+
+    def _store(self, event_id, event_type, payment_id):
+        return self.event_model._cybersource_store_event(self.provider, json.dumps({
+            'notificationId': event_id,
+            'eventType': event_type,
+            'payload': {'data': {'id': payment_id}},
+        }))
+
+    def _get_event(self, event_id):
+        return self.event_model.search([('event_id', '=', event_id)])
+
+    def test_signature_accepted(self):
+        body = b'{"notificationId": "accepted"}'
+        self.assertTrue(self.provider._cybersource_verify_webhook_signature(
+            body, self._sign(body)))
+        # Timestamps in milliseconds
+        self.assertTrue(self.provider._cybersource_verify_webhook_signature(
+            body, self._sign(body, int(time.time() * 1000))))
+
+    def test_signature_rejected(self):
+        body = b'{"notificationId": "rejected"}'
+        other_secret = base64.b64encode(b'another-secret').decode()
+        self.assertFalse(self.provider._cybersource_verify_webhook_signature(
+            body, self._sign(body, secret=other_secret)))
+        self.assertFalse(self.provider._cybersource_verify_webhook_signature(
+            b'{"notificationId": "tampered"}', self._sign(body)))
+        self.provider.cyber_webhook_secret = False
+        self.assertFalse(self.provider._cybersource_verify_webhook_signature(
+            body, self._sign(body)))
+
+    def test_signature_stale(self):
+        body = b'{"notificationId": "stale"}'
+        for timestamp in (int(time.time()) - 600, int(time.time()) + 600):
+            self.assertFalse(self.provider._cybersource_verify_webhook_signature(
+                body, self._sign(body, timestamp)))
+
+    def test_signature_malformed(self):
+        body = b'{"notificationId": "malformed"}'
+        signature = self._sign(body)
+        for header in (None, '', 'garbage', signature.split(';sig=')[0],
+                       signature.replace('t=', 't=abc'), 't=;sig=;keyId='):
+            self.assertFalse(self.provider._cybersource_verify_webhook_signature(
+                body, header), header)
+
+    def test_event_stored_once(self):
+        self.assertTrue(self._store('dedup', 'payments.payments.accept', 'P-DEDUP'))
+        self.assertFalse(self._store('dedup', 'payments.payments.accept', 'P-DEDUP'))
+        self.assertEqual(len(self._get_event('dedup')), 1)
+        with self.assertRaises(ValueError):
+            self.event_model._cybersource_store_event(
+                self.provider, json.dumps({'eventType': 'payments.payments.accept'}))
+
+    def test_event_superseded(self):
+        payment_id = self.tx.cybersource_payment_id
+        self._store('first', 'payments.payments.accept', payment_id)
+        self._store('review', 'risk.profile.decision.review', payment_id)
+        self._store('last', 'payments.payments.reject', payment_id)
+        events = self._get_event('first') | self._get_event('review') \
+            | self._get_event('last')
+        events._process_events()
+        self.assertRecordValues(events, [
+            {'state': 'done', 'message': "Superseded"},
+            {'state': 'done', 'message': "Nothing to update"},
+            {'state': 'done', 'message': False},
+        ])
+        self.assertEqual(self.tx.state, 'cancel')
+
+    def test_event_before_transaction(self):
+        self._store('early', 'payments.payments.accept', 'P-NOT-YET')
+        self._store('late', 'payments.payments.accept', 'P-NEVER')
+        early, late = self._get_event('early'), self._get_event('late')
+        late.received_date = fields.Datetime.now() - timedelta(hours=2)
+        (early | late)._process_events()
+        self.assertRecordValues(early | late, [
+            {'state': 'pending', 'message': "Waiting for the transaction"},
+            {'state': 'error', 'message': "No transaction found"},
+        ])
+
+    def test_event_capture(self):
+        self.provider.capture_manually = True
+        payment_id = self.tx.cybersource_payment_id
+        self._store('authorization', 'payments.payments.accept', payment_id)
+        self._get_event('authorization')._process_events()
+        self.assertEqual(self.tx.state, 'authorized')
+        self._store('capture', 'payments.captures.accept', payment_id)
+        self._get_event('capture')._process_events()
+        self.assertEqual(self.tx.state, 'done')
+
+    def test_processing_triggered_once(self):
+        cron = self.env.ref('advanced_payment_cybersource.ir_cron_cybersource_process_events')
+        triggers = self.env['ir.cron.trigger'].search([('cron_id', '=', cron.id)])
+        triggers.unlink()
+        for _index in range(3):
+            self.event_model._cybersource_trigger_processing()
+        self.assertEqual(self.env['ir.cron.trigger'].search_count(
+            [('cron_id', '=', cron.id)]), 1)
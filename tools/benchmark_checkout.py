@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+""" Load benchmark of the CyberSource checkout of a running Odoo server.
+
+Draft transactions are created through XML-RPC, then paid concurrently
+through /payment/cybersource/simulate_payment. Run it against a provider
+whose API Host points to tools/cybersource_mock.py:
+
+    python tools/benchmark_checkout.py --db bench --payments 2000 \\
+        --concurrency 32 --mix authorized=90,declined=5,pending=5 \\
+        --odoo-log /var/log/odoo/odoo.log
+
+The report gives the latency percentiles, the throughput and, when the Odoo
+log and processes are available, the queries per payment and the memory of
+the workers.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import threading
+import time
+import urllib.request
+import xmlrpc.client
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Test card number of each scenario of tools/cybersource_mock.py
+SCENARIO_CARDS = {
+    'authorized': '4111111111111111',
+    'declined': '4000000000000002',
+    'pending': '4000000000000003',
+    '3ds': '4000000000000004',
+    'slow': '4000000000000005',
+    'error': '4000000000000006',
+}
+
+# Request line of the werkzeug log, followed by the query count, the query
+# time and the remaining time of the request
+ODOO_LOG_REQUEST = re.compile(
+    r'"POST /payment/cybersource/simulate_payment HTTP/[\d.]+" \d+ - '
+    r'(\d+) ([\d.]+) ([\d.]+)')
+
+
+def parse_mix(value):
+    """ Parse `authorized=90,declined=10` into a list of weighted scenarios """
+    mix = []
+    for item in value.split(','):
+        scenario, _sep, weight = item.partition('=')
+        if scenario not in SCENARIO_CARDS:
+            raise argparse.ArgumentTypeError("Unknown scenario %s" % scenario)
+        mix.append((scenario, int(weight or 1)))
+    return mix
+
+
+def create_transactions(args, count):
+    """ Create `count` draft CyberSource transactions and return the payment
+    values shared by the requests and the references """
+    common = xmlrpc.client.ServerProxy('%s/xmlrpc/2/common' % args.url)
+    uid = common.authenticate(args.db, args.login, args.password, {})
+    models = xmlrpc.client.ServerProxy('%s/xmlrpc/2/object' % args.url,
+                                       allow_none=True)
+
+    def call(model, method, *params, **kwargs):
+        return models.execute_kw(args.db, uid, args.password, model, method,
+                                 list(params), kwargs)
+
+    provider = call('payment.provider', 'search_read',
+                    [('code', '=', 'cybersource'), ('state', '!=', 'disabled')],
+                    fields=['payment_method_ids', 'company_id'], limit=1)[0]
+    company = call('res.company', 'read', [provider['company_id'][0]],
+                   fields=['currency_id', 'partner_id'])[0]
+    partner_id = call('res.users', 'read', [uid], fields=['partner_id'])[0]['partner_id'][0]
+    prefix = 'BENCH-%s' % int(time.time())
+    references = ['%s-%s' % (prefix, index) for index in range(count)]
+    for start in range(0, count, 500):
+        call('payment.transaction', 'create', [{
+            'reference': reference,
+            'amount': args.amount,
+            'currency_id': company['currency_id'][0],
+            'provider_id': provider['id'],
+            'payment_method_id': provider['payment_method_ids'][0],
+            'partner_id': partner_id,
+            'operation': 'online_direct',
+        } for reference in references[start:start + 500]])
+    values = {
+        'amount': args.amount,
+        'currency': company['currency_id'][0],
+        'partner': partner_id,
+    }
+    return values, references
+
+
+def pay(args, values, reference, card_number):
+    """ Send one payment and return its latency and outcome """
+    body = json.dumps({
+        'jsonrpc': '2.0',
+        'method': 'call',
+        'params': {
+            'reference': reference,
+            'customer_input': {
+                'exp_year': '2030',
+                'exp_month': '12',
+                'name': 'Bench Mark',
+                'card_num': card_number,
+                'cvv': '123',
+                'device_fingerprint': reference,
+            },
+            'values': values,
+        },
+    }).encode()
+    http_request = urllib.request.Request(
+        '%s/payment/cybersource/simulate_payment' % args.url, data=body,
+        headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(http_request, timeout=args.timeout) as response:
+            result = json.loads(response.read())
+        outcome = 'rpc_error' if 'error' in result else (
+            (result.get('result') or {}).get('status') or 'ok')
+    except Exception:
+        outcome = 'http_error'
+    return time.perf_counter() - start, outcome
+
+
+def odoo_workers_memory(pids):
+    """ Return the resident memory in MB of the given or detected Odoo
+    processes, by pid """
+    if not pids:
+        for pid in filter(str.isdigit, os.listdir('/proc')):
+            try:
+                with open('/proc/%s/cmdline' % pid, 'rb') as cmdline:
+                    if b'odoo' in cmdline.read():
+                        pids.append(int(pid))
+            except OSError:
+                continue
+    memory = {}
+    for pid in pids:
+        try:
+            with open('/proc/%s/status' % pid) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        memory[pid] = int(line.split()[1]) / 1024
+        except OSError:
+            continue
+    return memory
+
+
+def percentile(values, rank):
+    """ Return the `rank` percentile of sorted values """
+    return values[min(len(values) - 1, int(len(values) * rank / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--login', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--payments', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--amount', type=float, default=10.0)
+    parser.add_argument('--mix', type=parse_mix, default='authorized=100',
+                        help='Weighted scenarios, e.g. authorized=90,declined=10')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--odoo-log', help='Odoo log file, for query counts')
+    parser.add_argument('--odoo-pid', type=int, action='append', default=[],
+                        help='Odoo process to measure, detected if omitted')
+    args = parser.parse_args()
+
+    print("Creating %s draft transactions..." % args.payments)
+    values, references = create_transactions(args, args.payments)
+    scenarios, weights = zip(*args.mix)
+    cards = [SCENARIO_CARDS[scenario] for scenario in
+             random.choices(scenarios, weights, k=args.payments)]
+    log_offset = os.path.getsize(args.odoo_log) if args.odoo_log else 0
+    memory_before = odoo_workers_memory(args.odoo_pid)
+
+    results = []
+    lock = threading.Lock()
+
+    def run(index):
+        result = pay(args, values, references[index], cards[index])
+        with lock:
+            results.append(result)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(run, range(args.payments)))
+    duration = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, _outcome in results)
+    print("\n%s payments in %.1fs, concurrency %s" % (
+        len(results), duration, args.concurrency))
+    print("Throughput: %.1f payments/s" % (len(results) / duration))
+    print("Latency (ms): p50 %.0f, p95 %.0f, p99 %.0f, mean %.0f, max %.0f" % (
+        percentile(latencies, 50), percentile(latencies, 95),
+        percentile(latencies, 99), statistics.mean(latencies), latencies[-1]))
+    print("Outcomes: %s" % dict(Counter(outcome for _latency, outcome in results)))
+
+    if args.odoo_log:
+        with open(args.odoo_log, errors='replace') as log:
+            log.seek(log_offset)
+            queries = [int(match.group(1)) for match in map(
+                ODOO_LOG_REQUEST.search, log) if match]
+        if queries:
+            print("Queries per payment: mean %.1f, max %s (%s requests logged)" % (
+                statistics.mean(queries), max(queries), len(queries)))
+    memory_after = odoo_workers_memory(args.odoo_pid)
+    for pid, memory in sorted(memory_after.items()):
+        print("Odoo process %s: %.0f MB (%+.0f MB)" % (
+            pid, memory, memory - memory_before.get(pid, memory)))
+
+
+if __name__ == '__main__':
+    main()
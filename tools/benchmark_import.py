@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+""" Import time and memory of the module in an Odoo worker.
+
+Each measure imports the module in a fresh interpreter, as a worker loading
+the registry does, and reports the time taken, the resident memory added and
+whether the CyberSource SDK got loaded:
+
+    python tools/benchmark_import.py --addons-path /opt/odoo/addons,/opt/custom
+
+`module` is what a worker pays at startup, the SDK being imported on the
+first CyberSource call only; `module + SDK` is the cost of a worker having
+processed a card, which every worker paid when the SDK was imported with the
+module. Without --addons-path, only the SDK import is measured.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MODULE = 'advanced_payment_cybersource'
+
+# Run in the fresh interpreter: print the time, RSS delta and SDK state
+PROBE = """
+import json, sys, time
+
+def rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+addons_path = %(addons_path)r
+if addons_path:
+    import odoo
+    odoo.tools.config.parse_config(['--addons-path', addons_path])
+    odoo.modules.module.initialize_sys_path()
+rss_before, start = rss(), time.perf_counter()
+if addons_path:
+    __import__('odoo.addons.%(module)s')
+if %(sdk)r:
+    import CyberSource
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'rss': rss() - rss_before,
+    'modules': len(sys.modules),
+    'sdk_loaded': 'CyberSource' in sys.modules,
+}))
+"""
+
+
+def probe(addons_path, sdk):
+    """ Return the measures of one import in a fresh interpreter """
+    code = PROBE % {'addons_path': addons_path, 'module': MODULE, 'sdk': sdk}
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--addons-path',
+                        help='Odoo addons path containing the module')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    cases = [('SDK', None, True)]
+    if args.addons_path:
+        cases = [('module', args.addons_path, False),
+                 ('module + SDK', args.addons_path, True)] + cases
+    print("%-14s %10s %10s %8s  %s" % ('import', 'seconds', 'RSS MiB',
+                                       'modules', 'SDK loaded'))
+    for name, addons_path, sdk in cases:
+        runs = [probe(addons_path, sdk) for _run in range(args.runs)]
+        print("%-14s %10.3f %10.1f %8d  %s" % (
+            name,
+            statistics.median(run['seconds'] for run in runs),
+            statistics.median(run['rss'] for run in runs) / 2 ** 20,
+            runs[-1]['modules'],
+            'yes' if runs[-1]['sdk_loaded'] else 'no'))
+
+
+if __name__ == '__main__':
+    main()
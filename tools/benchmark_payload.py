@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+""" Micro-benchmark of the building of the CyberSource payment requests.
+
+Compares, for the same payment, the former construction from the SDK model
+classes (Ptsv2payments* objects, __dict__ copies, recursive removal of the
+empty values and masked copy for the logs) with utils.build_payment_payload
+and utils.mask_payload, serialization included. The time and the
+allocations per request are measured: the peak of memory allocated while it
+is built, and the number and size of the memory blocks it holds once built,
+as traced by tracemalloc.
+
+    python tools/benchmark_payload.py --number 20000
+
+Both requests are also passed through the body processing of the SDK, and
+checked to be identical once sent.
+"""
+import argparse
+import copy
+import importlib.util
+import json
+import os
+import timeit
+import tracemalloc
+
+from CyberSource import CreatePaymentRequest, \
+    Ptsv2paymentsClientReferenceInformation, \
+    Ptsv2paymentsConsumerAuthenticationInformation, \
+    Ptsv2paymentsDeviceInformation, Ptsv2paymentsOrderInformation, \
+    Ptsv2paymentsOrderInformationAmountDetails, \
+    Ptsv2paymentsOrderInformationBillTo, Ptsv2paymentsPaymentInformation, \
+    Ptsv2paymentsPaymentInformationTokenizedCard, \
+    Ptsv2paymentsProcessingInformation
+from CyberSource.utilities.tracking.sdk_tracker import SdkTracker
+from authenticationsdk.util.Utility import process_body
+
+# The module's utils, loaded by path as it does not depend on Odoo
+_spec = importlib.util.spec_from_file_location(
+    'cybersource_utils', os.path.join(os.path.dirname(__file__), '..', 'utils.py'))
+utils = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(utils)
+
+CARD = {'number': '4111111111111111', 'exp_month': '12', 'exp_year': '2030',
+        'cvv': '123'}
+BILL_TO = {
+    'first_name': 'Jane', 'last_name': 'Doe', 'address1': '1 Main Street',
+    'locality': 'Guatemala', 'administrative_area': '01',
+    'postal_code': '01007', 'country': 'GT', 'email': 'jane@example.com',
+    'phone_number': '12345678',
+}
+
+
+def del_none(data):
+    """ Former removal of the empty values of the request """
+    for key, value in list(data.items()):
+        if value is None:
+            del data[key]
+        elif isinstance(value, dict):
+            del_none(value)
+    return data
+
+
+def build_with_models(use_3ds):
+    """ Former request construction from the SDK models, returning the
+    serialized request and its masked copy for the logs """
+    processing_information = Ptsv2paymentsProcessingInformation(
+        capture=True, commerce_indicator='vbv' if use_3ds else None)
+    tokenized_card = Ptsv2paymentsPaymentInformationTokenizedCard(
+        number=CARD['number'], expiration_month=CARD['exp_month'],
+        expiration_year=CARD['exp_year'], security_code=CARD['cvv'],
+        transaction_type='1')
+    payment_information = Ptsv2paymentsPaymentInformation(
+        tokenized_card=tokenized_card.__dict__)
+    amount_details = Ptsv2paymentsOrderInformationAmountDetails(
+        total_amount='10.00', currency='GTQ')
+    bill_to = Ptsv2paymentsOrderInformationBillTo(**BILL_TO)
+    order_information = Ptsv2paymentsOrderInformation(
+        amount_details=amount_details.__dict__, bill_to=bill_to.__dict__)
+    request_params = {
+        'client_reference_information':
+            Ptsv2paymentsClientReferenceInformation(code='S00001-1').__dict__,
+        'processing_information': processing_information.__dict__,
+        'payment_information': payment_information.__dict__,
+        'order_information': order_information.__dict__,
+        'device_information': Ptsv2paymentsDeviceInformation(
+            fingerprint_session_id='fingerprint').__dict__,
+    }
+    if use_3ds:
+        request_params['consumer_authentication_information'] = \
+            Ptsv2paymentsConsumerAuthenticationInformation(
+                cavv=utils.CYBERSOURCE_3DS_CAVV,
+                xid=utils.CYBERSOURCE_3DS_XID).__dict__
+    request_obj = del_none(CreatePaymentRequest(**request_params).__dict__)
+    masked_request = copy.deepcopy(request_obj)
+    card = masked_request['_payment_information']['_tokenized_card']
+    card['_number'] = 'XXXX' + card['_number'][-4:]
+    card['_security_code'] = 'XXX'
+    return json.dumps(request_obj), json.dumps(masked_request)
+
+
+def build_with_utils(use_3ds):
+    """ Current request construction, returning the serialized request and
+    its masked copy for the logs """
+    payload = utils.build_payment_payload(
+        'S00001-1', CARD, '10.00', 'GTQ', dict(BILL_TO), 'fingerprint',
+        use_3ds=use_3ds)
+    return (utils.serialize_payload(payload),
+            json.dumps(utils.mask_payload(payload)))
+
+
+def as_sent(body):
+    """ Return the request as sent by the SDK, after its body processing """
+    body = SdkTracker().insert_developer_id_tracker(
+        body, 'create_payment_request', 'api.cybersource.com', None)
+    return json.loads(process_body(body))
+
+
+def measure_allocations(build, use_3ds, number=100):
+    """ Return the peak of memory allocated while building a request, and
+    the number and size of the memory blocks held by a built request,
+    averaged over `number` requests kept alive """
+    build(use_3ds)
+    ignore_tracemalloc = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        build(use_3ds)
+        peak = tracemalloc.get_traced_memory()[1] - start
+        baseline = tracemalloc.take_snapshot().filter_traces(ignore_tracemalloc)
+        requests = [build(use_3ds) for _index in range(number)]
+        differences = tracemalloc.take_snapshot().filter_traces(
+            ignore_tracemalloc).compare_to(baseline, 'filename')
+    finally:
+        tracemalloc.stop()
+    del requests
+    return (peak, sum(diff.count_diff for diff in differences) / number,
+            sum(diff.size_diff for diff in differences) / number)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Number of requests built per measure')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print("%-14s %-6s %12s %12s %10s" % ('request', '', 'SDK models', 'utils',
+                                         'ratio'))
+    for use_3ds in (False, True):
+        old_body, new_body = build_with_models(use_3ds)[0], build_with_utils(use_3ds)[0]
+        if as_sent(old_body) != as_sent(new_body):
+            raise SystemExit("The requests differ once processed by the SDK")
+        timings = [
+            min(timeit.repeat(lambda: build(use_3ds), number=args.number,
+                              repeat=args.repeat)) / args.number * 1e6
+            for build in (build_with_models, build_with_utils)
+        ]
+        allocations = [measure_allocations(build, use_3ds)
+                       for build in (build_with_models, build_with_utils)]
+        name = '3-D Secure' if use_3ds else 'plain'
+        print("%-14s %-6s %10.1fus %10.1fus %9.1fx" % (
+            name, 'time', timings[0], timings[1], timings[0] / timings[1]))
+        for index, (label, unit) in enumerate((('peak', 'B'), ('blocks', ''),
+                                                ('held', 'B'))):
+            old, new = allocations[0][index], allocations[1][index]
+            print("%-14s %-6s %11.0f%s %11.0f%s %9.1fx" % (
+                '', label, old, unit or ' ', new, unit or ' ', old / (new or 1)))
+        print("%-14s %-6s %12s %12s" % ('', 'bytes', len(old_body), len(new_body)))
+
+
+if __name__ == '__main__':
+    main()
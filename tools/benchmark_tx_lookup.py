@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+""" Benchmark of the CyberSource transaction lookups on a large table.
+
+Seeds copies of an existing CyberSource transaction into the database of an
+Odoo instance having the module installed, up to each requested size, and
+measures the lookups by reference, CyberSource payment id, provider
+reference and approval code:
+
+    python tools/benchmark_tx_lookup.py --dsn dbname=bench --steps 100000,1000000,5000000
+
+Constant timings and index scans across the sizes show the lookups do not
+depend on the table size. Seeded rows are removed with --cleanup.
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+import psycopg2
+
+SEED_PREFIX = 'SEED-'
+
+# Lookups measured, by name: query and function building the key of a row
+LOOKUPS = {
+    'reference': ("SELECT id FROM payment_transaction WHERE reference = %s LIMIT 1",
+                  lambda n: '%s%s' % (SEED_PREFIX, n)),
+    'cybersource_payment_id': (
+        "SELECT id FROM payment_transaction WHERE cybersource_payment_id = %s LIMIT 1",
+        lambda n: 'P%021d' % n),
+    'provider_reference': (
+        "SELECT id FROM payment_transaction WHERE provider_reference = %s LIMIT 1",
+        lambda n: 'R%010d' % n),
+    'cybersource_approval_code': (
+        "SELECT id FROM payment_transaction WHERE cybersource_approval_code = %s LIMIT 1",
+        lambda n: 'A%010d' % n),
+}
+
+# Columns given their own value in the seeded rows
+SEED_COLUMNS = {
+    'reference': "'%s' || n" % SEED_PREFIX,
+    'cybersource_payment_id': "'P' || lpad(n::text, 21, '0')",
+    'provider_reference': "'R' || lpad(n::text, 10, '0')",
+    'cybersource_approval_code': "'A' || lpad(n::text, 10, '0')",
+}
+
+
+def seed(cr, target):
+    """ Add seeded transactions, copied from a CyberSource transaction, until
+    the table holds `target` of them """
+    cr.execute("SELECT count(*) FROM payment_transaction WHERE reference LIKE %s",
+               [SEED_PREFIX + '%'])
+    existing = cr.fetchone()[0]
+    if existing >= target:
+        return
+    cr.execute("""
+        SELECT tx.id FROM payment_transaction tx
+        JOIN payment_provider provider ON provider.id = tx.provider_id
+        WHERE provider.code = 'cybersource' ORDER BY tx.id LIMIT 1
+    """)
+    row = cr.fetchone()
+    if not row:
+        raise SystemExit("Create one CyberSource transaction to copy first")
+    cr.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'payment_transaction' AND column_name != 'id'
+    """)
+    columns = [name for (name,) in cr.fetchall()]
+    values = [SEED_COLUMNS.get(name, 'tx.%s' % name) for name in columns]
+    for start in range(existing, target, 100000):
+        cr.execute("""
+            INSERT INTO payment_transaction (%s)
+            SELECT %s FROM payment_transaction tx,
+                 generate_series(%%s, %%s) AS n
+            WHERE tx.id = %%s
+        """ % (', '.join(columns), ', '.join(values)),
+                   [start, min(start + 100000, target) - 1, row[0]])
+        cr.connection.commit()
+    cr.execute("ANALYZE payment_transaction")
+    cr.connection.commit()
+
+
+def measure(cr, size, samples):
+    """ Return the mean execution time in ms and the plan of each lookup """
+    results = {}
+    for name, (query, key) in LOOKUPS.items():
+        timings, plan = [], None
+        for n in random.sample(range(size), min(samples, size)):
+            cr.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query, [key(n)])
+            explain = cr.fetchone()[0]
+            explain = json.loads(explain) if isinstance(explain, str) else explain
+            timings.append(explain[0]['Execution Time'])
+            node = explain[0]['Plan']
+            while node.get('Plans'):
+                node = node['Plans'][0]
+            plan = '%s on %s' % (node['Node Type'], node.get('Index Name', node.get('Relation Name')))
+        results[name] = (statistics.mean(timings), plan)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dsn', required=True, help='libpq connection string')
+    parser.add_argument('--steps', default='100000,1000000,3000000',
+                        help='Comma separated numbers of seeded transactions')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--cleanup', action='store_true',
+                        help='Remove the seeded transactions and exit')
+    args = parser.parse_args()
+    connection = psycopg2.connect(args.dsn)
+    cr = connection.cursor()
+    if args.cleanup:
+        cr.execute("DELETE FROM payment_transaction WHERE reference LIKE %s",
+                   [SEED_PREFIX + '%'])
+        connection.commit()
+        print("%s seeded transactions removed" % cr.rowcount)
+        return
+    for size in map(int, args.steps.split(',')):
+        start = time.monotonic()
+        seed(cr, size)
+        print("\n%s seeded transactions (seeding %.0fs)" % (size, time.monotonic() - start))
+        for name, (timing, plan) in measure(cr, size, args.samples).items():
+            print("  %-26s %.3f ms  %s" % (name, timing, plan))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+""" Check that the CyberSource client reuses its keep-alive connection.
+
+Sends payments one after the other through the CyberSource provider of a
+database, against tools/cybersource_mock.py, then checks on the pool
+statistics of the client that a single connection carried all of them:
+
+    python tools/cybersource_mock.py --port 8099 &
+    python tools/check_connection_reuse.py -c /etc/odoo/odoo.conf --db bench \\
+        --payments 20
+
+The API host of the provider is only changed within the check, which is
+rolled back. Exits with status 1 when the connection was not reused.
+"""
+import argparse
+import json
+import sys
+
+import odoo
+from odoo import SUPERUSER_ID, api
+
+CARD = {'number': '4111111111111111', 'exp_month': '12', 'exp_year': '2030',
+        'cvv': '123'}
+BILL_TO = {'first_name': 'Pool', 'last_name': 'Check', 'country': 'US'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-c', '--config', help='Odoo configuration file')
+    parser.add_argument('--addons-path')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--mock-url', default='http://127.0.0.1:8099')
+    parser.add_argument('--payments', type=int, default=20)
+    args = parser.parse_args()
+    odoo_args = ['-c', args.config] if args.config else []
+    if args.addons_path:
+        odoo_args += ['--addons-path', args.addons_path]
+    odoo.tools.config.parse_config(odoo_args)
+    odoo.modules.module.initialize_sys_path()
+    from odoo.addons.advanced_payment_cybersource import utils
+
+    registry = odoo.modules.registry.Registry(args.db)
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        provider = env['payment.provider']._cybersource_get_provider()
+        if not provider:
+            sys.exit("No enabled CyberSource provider in %s" % args.db)
+        provider.cyber_run_environment = args.mock_url
+        tx_model = env['payment.transaction']
+        for index in range(args.payments):
+            payload = utils.build_payment_payload(
+                'POOL-CHECK-%s' % index, CARD, '10.00', 'USD', BILL_TO, '')
+            status = tx_model._cybersource_send_payment(provider, payload)[1]
+            if status != 201:
+                sys.exit("Payment %s failed with HTTP status %s" % (index, status))
+        stats = provider._cybersource_get_pool_stats()
+        cr.rollback()
+    print(json.dumps(stats, indent=2))
+    if (len(stats) != 1 or stats[0]['open_connections'] != 1
+            or stats[0]['requests'] != args.payments):
+        sys.exit("FAILED: %s payments did not share a single connection"
+                 % args.payments)
+    print("OK: %s payments sent over a single connection" % args.payments)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+""" Local stand-in for the CyberSource REST API, for load tests and
+benchmarks. Point the provider API Host to http://localhost:8099 and run:
+
+    python tools/cybersource_mock.py --port 8099 --latency 120
+
+The outcome of an authorization depends on the last four digits of the card
+number, see SCENARIOS, payments with stored tokens being authorized. The
+requests answered are kept in memory, by reference, for transaction searches.
+With --server-error, processed requests are answered with that HTTP status,
+as CyberSource does when it times out internally. Signatures are not checked. Give a certificate to serve HTTPS, as
+CyberSource does:
+
+    python tools/cybersource_mock.py --certfile cert.pem --keyfile key.pem
+"""
+import argparse
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Authorization outcome by last four digits of the card number, any other
+# card is authorized
+SCENARIOS = {
+    '1111': 'authorized',
+    '0002': 'declined',
+    '0003': 'pending',
+    '0004': '3ds',
+    '0005': 'slow',
+    '0006': 'error',
+}
+
+FOLLOW_UP_STATUSES = {
+    'captures': 'PENDING',
+    'refunds': 'PENDING',
+    'reversals': 'REVERSED',
+    'voids': 'VOIDED',
+}
+
+# Application run by each request, as reported by transaction searches
+APPLICATIONS = {
+    'payments': 'ics_auth',
+    'captures': 'ics_bill',
+    'refunds': 'ics_credit',
+    'reversals': 'ics_auth_reversal',
+    'voids': 'ics_void',
+}
+
+# Summaries of the answered requests by reference, the latest first
+_transactions_lock = threading.Lock()
+_transactions = {}
+
+
+class CyberSourceMockHandler(BaseHTTPRequestHandler):
+    """ Answer the Payments, Transaction Details and Search API requests """
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    slow_delay = 5.0
+    # HTTP status answered to the processed payments and follow-ups, e.g. 502
+    # for a server timeout, the request being kept for searches
+    server_error = None
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(
+            int(self.headers.get('Content-Length') or 0)) or b'{}')
+        self._sleep()
+        if self.path.rstrip('/') == '/tss/v2/searches':
+            return self._search(body)
+        if self.path.rstrip('/') == '/pts/v2/payments':
+            status, response = self._authorize(body)
+        else:
+            match = re.match(
+                r'^/pts/v2/payments/(\w+)/(captures|refunds|reversals|voids)$',
+                self.path)
+            if not match:
+                return self._respond(404, {'message': 'Unknown resource'})
+            status, response = 201, self._payment_response(
+                body, FOLLOW_UP_STATUSES[match.group(2)], match.group(2))
+        if status == 201 and self.server_error:
+            status, response = self.server_error, {
+                'status': 'SERVER_ERROR',
+                'reason': 'SERVER_TIMEOUT',
+                'message': 'Error - General system failure',
+            }
+        return self._respond(status, response)
+
+    def do_GET(self):
+        self._sleep()
+        match = re.match(r'^/tss/v2/transactions/(\w+)$', self.path)
+        if not match:
+            return self._respond(404, {'message': 'Unknown resource'})
+        return self._respond(200, {
+            'id': match.group(1),
+            'applicationInformation': {
+                'status': 'TRANSMITTED',
+                'applications': [{'name': 'ics_auth', 'rCode': '1',
+                                  'reasonCode': '100'}],
+            },
+        })
+
+    def _authorize(self, body):
+        card_number = body.get('paymentInformation', {}).get(
+            'tokenizedCard', {}).get('number', '')
+        scenario = SCENARIOS.get(card_number[-4:], 'authorized')
+        if scenario == '3ds' and not body.get(
+                'consumerAuthenticationInformation', {}).get('cavv'):
+            return 400, {
+                'status': 'INVALID_REQUEST',
+                'reason': 'MISSING_FIELD',
+                'message': 'Declined - The request is missing one or more fields',
+                'details': [{'field': 'consumerAuthenticationInformation.cavv',
+                             'reason': 'MISSING_FIELD'}],
+            }
+        if scenario == 'error':
+            return 502, {'message': 'Bad gateway'}
+        if scenario == 'slow':
+            time.sleep(self.slow_delay)
+        status = {'declined': 'DECLINED',
+                  'pending': 'AUTHORIZED_PENDING_REVIEW'}.get(scenario, 'AUTHORIZED')
+        response = self._payment_response(body, status, 'payments')
+        if 'TOKEN_CREATE' in body.get('processingInformation', {}).get('actionList', []):
+            response['tokenInformation'] = {
+                'customer': {'id': '%032X' % random.getrandbits(128)},
+                'paymentInstrument': {'id': '%032X' % random.getrandbits(128)},
+            }
+        return 201, response
+
+    def _payment_response(self, body, status, resource):
+        response = {
+            'id': ''.join(random.choices('0123456789', k=22)),
+            'status': status,
+            'submitTimeUtc': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'clientReferenceInformation': body.get('clientReferenceInformation', {}),
+            'processorInformation': {
+                'approvalCode': '%06d' % random.randint(0, 999999),
+                'responseCode': '00' if status != 'DECLINED' else '05',
+                'networkTransactionId': ''.join(random.choices('0123456789', k=15)),
+            },
+        }
+        r_code = '0' if status == 'DECLINED' else '1'
+        summary = dict(response, applicationInformation={
+            'rCode': r_code,
+            'applications': [{'name': APPLICATIONS[resource], 'rCode': r_code}],
+        })
+        with _transactions_lock:
+            _transactions.setdefault(
+                response['clientReferenceInformation'].get('code'), []).insert(0, summary)
+        return response
+
+    def _search(self, body):
+        match = re.match(r'^clientReferenceInformation\.code:"?(.*?)"?$',
+                         body.get('query', ''))
+        reference = match and match.group(1).replace('\\"', '"')
+        with _transactions_lock:
+            summaries = list(_transactions.get(reference, []))[:body.get('limit', 20)]
+        return self._respond(201, {
+            'searchId': '%032x' % random.getrandbits(128),
+            'query': body.get('query'),
+            'count': len(summaries),
+            'totalCount': len(summaries),
+            '_embedded': {'transactionSummaries': summaries},
+        })
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+    def _respond(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/hal+json;charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('v-c-correlation-id', '%032x' % random.getrandbits(128))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host, port, certfile=None, keyfile=None):
+    """ Return the mock server, serving HTTPS when a certificate is given """
+    server = ThreadingHTTPServer((host, port), CyberSourceMockHandler)
+    server.daemon_threads = True
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Mean response delay in milliseconds')
+    parser.add_argument('--slow-delay', type=float, default=5,
+                        help='Delay of the slow scenario in seconds')
+    parser.add_argument('--server-error', type=int,
+                        help='HTTP status answered to the processed requests')
+    parser.add_argument('--certfile', help='PEM certificate, to serve HTTPS')
+    parser.add_argument('--keyfile', help='PEM private key of the certificate')
+    args = parser.parse_args()
+    CyberSourceMockHandler.latency = args.latency / 1000
+    CyberSourceMockHandler.slow_delay = args.slow_delay
+    CyberSourceMockHandler.server_error = args.server_error
+    server = make_server(args.host, args.port, args.certfile, args.keyfile)
+    print("CyberSource mock listening on %s://%s:%s" % (
+        'https' if args.certfile else 'http', args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+import threading
+import time
+from xml.etree import ElementTree
+
+# Test 3-D Secure values sent when CyberSource requires authentication data
+CYBERSOURCE_3DS_CAVV = 'AAABCSIIAAAAAAACcwgAEMCoNh+='
+CYBERSOURCE_3DS_XID = 'T1Y0OVcxMVJJdkI0WFlBcXptUzE='
+
+# Upper bounds of the histogram buckets of the checkout stages, in seconds and
+# in SQL queries, the last bucket being unbounded
+STAGE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STAGE_QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# Column names of the CyberSource CSV reports, by normalized field
+REPORT_CSV_COLUMNS = {
+    'request_id': ('request_id', 'RequestID', 'Request ID'),
+    'reference': ('merchant_ref_number', 'MerchantReferenceNumber',
+                  'Merchant Reference Number'),
+    'amount': ('amount', 'Amount'),
+    'currency': ('currency', 'Currency', 'CurrencyCode'),
+}
+
+
+def build_payment_payload(reference, card, amount, currency, bill_to,
+                          fingerprint_session_id, capture=True, use_3ds=False):
+    """ Build the CyberSource authorization request as a plain dict, the
+    given values being sent as they are, e.g. an empty fingerprint session id
+    when the device fingerprint is missing. Keys are in the snake_case layout
+    expected by the SDK, which camel-cases them and adds its developer id
+    before sending.
+
+    :param str reference: The transaction reference
+    :param dict card: The card data, with keys `number`, `exp_month`,
+                      `exp_year` and `cvv`
+    :param amount: The amount to authorize
+    :param str currency: The ISO code of the currency
+    :param dict bill_to: The billing information, with snake_case keys
+    :param str fingerprint_session_id: The device fingerprint session id
+    :param bool capture: Whether the authorization is captured immediately
+    :param bool use_3ds: Whether the 3-D Secure information is included
+    :return: The authorization request
+    :rtype: dict
+    """
+    payload = {
+        'client_reference_information': {'code': reference},
+        'processing_information': {'capture': capture},
+        'payment_information': {
+            'tokenized_card': {
+                'number': card['number'],
+                'expiration_month': card['exp_month'],
+                'expiration_year': card['exp_year'],
+                'security_code': card['cvv'],
+                'transaction_type': '1',
+            },
+        },
+        'order_information': {
+            'amount_details': {'total_amount': amount, 'currency': currency},
+            'bill_to': bill_to,
+        },
+        'device_information': {
+            'fingerprint_session_id': fingerprint_session_id,
+        },
+    }
+    if use_3ds:
+        apply_3ds(payload)
+    return payload
+
+
+def build_token_payment_payload(reference, customer_id, instrument_id, amount,
+                                currency, capture=True, merchant_initiated=False,
+                                previous_transaction_id=None):
+    """ Build an authorization request charging stored CyberSource tokens.
+    The card and billing address are held by the payment instrument, so
+    only the amount is sent, with the stored credential indicators: the
+    charges made without the customer, e.g. of due invoices, are flagged as
+    merchant initiated and refer to the network transaction id of the
+    payment which stored the card. """
+    payment_information = {'payment_instrument': {'id': instrument_id}}
+    if customer_id:
+        payment_information['customer'] = {'id': customer_id}
+    initiator = {
+        'type': 'merchant' if merchant_initiated else 'customer',
+        'stored_credential_used': True,
+    }
+    if merchant_initiated and previous_transaction_id:
+        initiator['merchant_initiated_transaction'] = {
+            'previous_transaction_id': previous_transaction_id,
+        }
+    return {
+        'client_reference_information': {'code': reference},
+        'processing_information': {
+            'capture': capture,
+            'commerce_indicator': 'internet',
+            'authorization_options': {'initiator': initiator},
+        },
+        'payment_information': payment_information,
+        'order_information': {
+            'amount_details': {'total_amount': amount, 'currency': currency},
+        },
+    }
+
+
+def apply_token_creation(payload):
+    """ Ask CyberSource to store the card of an authorization request as
+    customer and payment instrument tokens, flagging it as the customer
+    initiated payment storing the credential """
+    payload['processing_information'].update({
+        'action_list': ['TOKEN_CREATE'],
+        'action_token_types': ['customer', 'paymentInstrument'],
+        'authorization_options': {'initiator': {
+            'type': 'customer',
+            'credential_stored_on_file': True,
+        }},
+    })
+    return payload
+
+
+def build_amount_payload(reference, amount, currency):
+    """ Build a follow-up request (capture, refund) carrying only the
+    reference and amount of the operation """
+    return {
+        'client_reference_information': {'code': reference},
+        'order_information': {
+            'amount_details': {'total_amount': amount, 'currency': currency},
+        },
+    }
+
+
+def build_reversal_payload(reference, amount):
+    """ Build an authorization reversal request for the full amount """
+    return {
+        'client_reference_information': {'code': reference},
+        'reversal_information': {
+            'amount_details': {'total_amount': amount},
+            'reason': 'Authorization expired',
+        },
+    }
+
+
+def build_search_payload(reference):
+    """ Build a transaction search request for the transactions sent with
+    the given reference, the latest first """
+    return {
+        'save': False,
+        'name': 'Reference %s' % reference,
+        'timezone': 'UTC',
+        'query': 'clientReferenceInformation.code:"%s"' % reference.replace(
+            '"', '\\"'),
+        'offset': 0,
+        'limit': 20,
+        'sort': 'submitTimeUtc:desc',
+    }
+
+
+def get_search_result(response_data, application):
+    """ Return the summary of the latest transaction of a transaction search
+    response running the given application, e.g. `ics_auth` or `ics_credit`,
+    with whether that application succeeded, or None if there is none
+
+    :rtype: tuple
+    """
+    summaries = response_data.get('_embedded', {}).get('transactionSummaries', [])
+    for summary in summaries:
+        applications = summary.get('applicationInformation', {}).get(
+            'applications', [])
+        for summary_application in applications:
+            if summary_application.get('name') == application:
+                return summary, summary_application.get('rCode') == '1'
+    return None
+
+
+def get_transaction_decision(details):
+    """ Return the transaction state matching the decision found in the
+    transaction details of CyberSource, or None while it is still pending
+    (review held or not yet processed) """
+    decision = details.get('riskInformation', {}).get(
+        'profile', {}).get('decision', '').upper()
+    if decision == 'REJECT':
+        return 'cancel'
+    if decision == 'REVIEW':
+        return None
+    applications = details.get('applicationInformation', {}).get(
+        'applications', [])
+    for application in applications:
+        if application.get('name') == 'ics_auth':
+            if application.get('rCode') == '1':
+                return 'done'
+            if application.get('rCode') in ('0', '-1'):
+                return 'cancel'
+    return None
+
+
+def is_outcome_unknown(status):
+    """ Return whether a request answered with the given HTTP status, None
+    when no response was received, may have been processed by CyberSource.
+    Server errors, e.g. a 502 SERVER_TIMEOUT or a 504, are no answer. """
+    return status is None or status >= 500
+
+
+def apply_3ds(payload):
+    """ Add the 3-D Secure information to an authorization request """
+    payload['processing_information']['commerce_indicator'] = 'vbv'
+    payload['consumer_authentication_information'] = {
+        'cavv': CYBERSOURCE_3DS_CAVV,
+        'xid': CYBERSOURCE_3DS_XID,
+    }
+    return payload
+
+
+def serialize_payload(payload):
+    """ Return the compact JSON body of an authorization request """
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def mask_payload(payload):
+    """ Return a copy of an authorization request with the card number and
+    security code masked, for logging. Only the branch holding the card is
+    copied. """
+    card = payload.get('payment_information', {}).get('tokenized_card')
+    if not card:
+        return payload
+    masked_card = dict(card)
+    if masked_card.get('number'):
+        masked_card['number'] = 'XXXX' + masked_card['number'][-4:]
+    if masked_card.get('security_code'):
+        masked_card['security_code'] = 'XXX'
+    return dict(payload, payment_information=dict(
+        payload['payment_information'], tokenized_card=masked_card))
+
+
+class RateLimiter:
+    """ Space the calls of concurrent threads to at most `rate` per second.
+    A rate of 0 disables the limit. """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = time.monotonic()
+
+    def wait(self):
+        """ Block until the next call is allowed """
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+def iter_report_rows(report):
+    """ Stream the rows of a CyberSource transaction detail or settlement
+    report, CSV or XML, without loading it in memory.
+
+    :param report: The path of the report or a binary file object
+    :return: Generator of dicts with keys `request_id`, `reference`,
+             `amount` (float or None) and `currency`
+    """
+    stream = open(report, 'rb') if isinstance(report, str) else report
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+    try:
+        if stream.peek(64).lstrip(b'\xef\xbb\xbf \r\n\t').startswith(b'<'):
+            yield from _iter_xml_report_rows(stream)
+        else:
+            text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig',
+                                           newline='')
+            try:
+                yield from _iter_csv_report_rows(text_stream)
+            finally:
+                text_stream.detach()
+    finally:
+        if isinstance(report, str):
+            stream.close()
+        elif stream is not report:
+            stream.detach()
+
+
+def _iter_csv_report_rows(stream):
+    """ Stream the rows of a CSV report, skipping the report description
+    lines preceding the header """
+    columns = None
+    for row in csv.reader(stream):
+        if columns is None:
+            header = {name.strip(): index for index, name in enumerate(row)}
+            columns = {
+                field: next((header[name] for name in names if name in header),
+                            None)
+                for field, names in REPORT_CSV_COLUMNS.items()
+            }
+            if columns['request_id'] is None and columns['reference'] is None:
+                columns = None
+            continue
+        values = {
+            field: row[index].strip() if index is not None and index < len(row) else ''
+            for field, index in columns.items()
+        }
+        yield dict(values, amount=_parse_amount(values['amount']))
+
+
+def _iter_xml_report_rows(stream):
+    """ Stream the Request elements of an XML report, dropping each one
+    once read """
+    parents = []
+    for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag.rsplit('}', 1)[-1] != 'Request':
+            continue
+        amount = currency = ''
+        for child in element.iter():
+            tag = child.tag.rsplit('}', 1)[-1]
+            if tag in ('Amount', 'GrandTotal') and not amount:
+                amount = (child.text or '').strip()
+            elif tag == 'Currency' and not currency:
+                currency = (child.text or '').strip()
+        yield {
+            'request_id': element.get('RequestID', ''),
+            'reference': element.get('MerchantReferenceNumber', ''),
+            'amount': _parse_amount(amount),
+            'currency': currency,
+        }
+        if parents:
+            parents[-1].remove(element)
+
+
+def _parse_amount(value):
+    """ Return the report amount as a float, or None when absent """
+    try:
+        return float(value.replace(',', '')) if value else None
+    except ValueError:
+        return None
+
+
+class StageTimer:
+    """ Measure the duration and SQL query count of the consecutive stages of
+    a request. Each call to `lap` closes the stage started by the previous
+    one. """
+
+    def __init__(self, cr):
+        self.cr = cr
+        self.stages = []
+        self._last_time = time.perf_counter()
+        self._last_queries = cr.sql_log_count
+
+    def lap(self, stage):
+        """ Record the stage ending now """
+        now, queries = time.perf_counter(), self.cr.sql_log_count
+        self.stages.append((stage, now - self._last_time,
+                            queries - self._last_queries))
+        self._last_time, self._last_queries = now, queries
+
+
+def add_to_histograms(histograms, stages):
+    """ Add the (stage, seconds, queries) measures to the histograms, a dict
+    of the form {kind: {stage: {'buckets': [...], 'sum': x, 'count': n}}},
+    the whole request being counted as the `total` stage """
+    stages = list(stages) + [('total', sum(stage[1] for stage in stages),
+                              sum(stage[2] for stage in stages))]
+    for stage, seconds, queries in stages:
+        for kind, bounds, value in (('seconds', STAGE_SECONDS_BUCKETS, seconds),
+                                    ('queries', STAGE_QUERIES_BUCKETS, queries)):
+            histogram = histograms.setdefault(kind, {}).setdefault(stage, {
+                'buckets': [0] * (len(bounds) + 1), 'sum': 0, 'count': 0})
+            index = next((i for i, bound in enumerate(bounds) if value <= bound),
+                         len(bounds))
+            histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+    return histograms
+
+
+def merge_histograms(histograms, other):
+    """ Add the `other` histograms to `histograms` """
+    for kind, stages in other.items():
+        for stage, histogram in stages.items():
+            target = histograms.setdefault(kind, {}).setdefault(stage, {
+                'buckets': [0] * len(histogram['buckets']), 'sum': 0, 'count': 0})
+            target['buckets'] = [a + b for a, b in zip(target['buckets'],
+                                                       histogram['buckets'])]
+            target['sum'] += histogram['sum']
+            target['count'] += histogram['count']
+    return histograms
+
+
+def render_prometheus(histograms_by_provider):
+    """ Render the checkout stage histograms in the Prometheus text format
+
+    :param dict histograms_by_provider: The histograms by provider name
+    :rtype: str
+    """
+    lines = []
+    for kind, bounds, unit in (('seconds', STAGE_SECONDS_BUCKETS, 'seconds'),
+                               ('queries', STAGE_QUERIES_BUCKETS, 'queries')):
+        name = 'cybersource_checkout_stage_%s' % unit
+        lines += ['# HELP %s CyberSource checkout %s per stage' % (name, unit),
+                  '# TYPE %s histogram' % name]
+        for provider, histograms in sorted(histograms_by_provider.items()):
+            for stage, histogram in sorted(histograms.get(kind, {}).items()):
+                labels = 'provider="%s",stage="%s"' % (
+                    provider.replace('\\', '\\\\').replace('"', '\\"'), stage)
+                cumulative = 0
+                for bound, count in zip(bounds + ('+Inf',), histogram['buckets']):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (
+                        name, labels, bound, cumulative))
+                lines.append('%s_sum{%s} %s' % (name, labels, histogram['sum']))
+                lines.append('%s_count{%s} %s' % (name, labels, histogram['count']))
+    return '\n'.join(lines) + '\n'